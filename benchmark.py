@@ -0,0 +1,339 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+import pandas as pd
+import numpy as np
+from data_preprocessing import *
+from eda import *
+from recommendations import *
+from data_loaders import load_portfolio, load_profile
+from synthetic_data import generate_datasets
+
+
+def scale_data(df, profile, factor):
+    """ Replicate the merged data and the profile data to simulate a larger
+    number of customers. Every copy gets its own customer ids.
+    Input:
+    - df: merged dataframe with transactions, customer and offer data
+    - profile: cleaned profile dataset
+    - factor: number of copies
+    Output:
+    - (df, profile): tuple with the scaled dataframes
+    """
+    dfs = []
+    profiles = []
+    for i in range(factor):
+        suffix = '_{}'.format(i) if i else ''
+        dfs.append(df.assign(customer_id=df.customer_id + suffix))
+        profiles.append(profile.assign(customer_id=profile.customer_id + suffix))
+    return (pd.concat(dfs, ignore_index=True),
+            pd.concat(profiles, ignore_index=True))
+
+
+def time_function(func, *args, repeat=3):
+    """ Time a function call
+    Input:
+    - func: function to be timed
+    - args: arguments of the function
+    - repeat: number of calls, the best one is returned
+    Output:
+    - best wall time in seconds
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def benchmark_per_customer_data(df, profile, factors=(1, 2, 4, 8)):
+    """ Compare per_customer_data and per_customer_data_fast for an
+    increasing number of transcript rows
+    Input:
+    - df: merged dataframe with transactions, customer and offer data
+    - profile: cleaned profile dataset
+    - factors: scale factors applied to the data
+    Output:
+    - results: dataframe with the timings per number of rows
+    """
+    results = []
+    for factor in factors:
+        df_scaled, profile_scaled = scale_data(df, profile, factor)
+        results.append({
+            'rows': len(df_scaled),
+            'per_customer_data': time_function(per_customer_data, df_scaled,
+                                               profile_scaled),
+            'per_customer_data_fast': time_function(per_customer_data_fast,
+                                                    df_scaled, profile_scaled)
+        })
+    results = pd.DataFrame(results).set_index('rows')
+    results['speedup'] = (results['per_customer_data'] /
+                          results['per_customer_data_fast'])
+    return results
+
+
+def benchmark_parallel(df, profile, workers=(1, 2, 4)):
+    """ Time per_customer_data_parallel for an increasing number of workers
+    Input:
+    - df: merged dataframe with transactions, customer and offer data
+    - profile: cleaned profile dataset
+    - workers: numbers of workers to be timed
+    Output:
+    - results: dataframe with the timings and the speedup over the serial
+    per_customer_data_fast
+    """
+    serial = time_function(per_customer_data_fast, df, profile)
+    results = pd.DataFrame(
+        {'time': [time_function(per_customer_data_parallel, df, profile, n)
+                  for n in workers]}, index=pd.Index(workers, name='workers'))
+    results['speedup'] = serial / results['time']
+    return results
+
+
+def benchmark_attribution(df, profile, factors=(1, 10)):
+    """ Time attribute_transactions for an increasing number of transcript
+    rows
+    Input:
+    - df: merged dataframe with transactions, customer and offer data
+    - profile: cleaned profile dataset
+    - factors: scale factors applied to the data
+    Output:
+    - results: dataframe with the timings per number of rows
+    """
+    results = []
+    for factor in factors:
+        df_scaled, _ = scale_data(df, profile, factor)
+        results.append({'rows': len(df_scaled),
+                        'attribute_transactions': time_function(
+                            attribute_transactions, df_scaled)})
+    return pd.DataFrame(results).set_index('rows')
+
+
+def benchmark_recommendations(customers, profile, n_top=2, sample=200):
+    """ Compare the throughput of get_most_popular_offers_filtered, called
+    once per profile row, with get_most_popular_offers_batch
+    Input:
+    - customers: dataframe with aggregated data of the offers
+    - profile: dataframe with income, age and gender columns
+    - n_top: number of offers to be returned
+    - sample: number of rows scored one by one
+    Output:
+    - results: series with the rows per second of each method
+    """
+    rows = profile.sample(min(sample, len(profile)), random_state=0)
+    start = time.perf_counter()
+    for income, age, gender in zip(rows.income, rows.age, rows.gender):
+        get_most_popular_offers_filtered(customers, n_top, income=income,
+                                         age=age, gender=gender)
+    loop = len(rows) / (time.perf_counter() - start)
+    batch = len(profile) / time_function(get_most_popular_offers_batch,
+                                         customers, profile, n_top)
+    return pd.Series({'get_most_popular_offers_filtered': loop,
+                      'get_most_popular_offers_batch': batch},
+                     name='rows per second')
+
+
+def benchmark_import_time(repeat=5):
+    """ Time the cold start of a process that imports recommendations, with
+    and without matplotlib.pyplot being loaded as well
+    Input:
+    - repeat: number of processes started, the best time is returned
+    Output:
+    - results: series with the import time in seconds of each case
+    """
+    code = ('import sys, time; t = time.perf_counter(); {}; '
+            'print(time.perf_counter() - t)')
+    cases = {'recommendations': 'import recommendations',
+             'recommendations + matplotlib.pyplot':
+             'import matplotlib.pyplot, recommendations'}
+    results = dict()
+    for name, statement in cases.items():
+        results[name] = min(float(subprocess.run(
+            [sys.executable, '-c', code.format(statement)],
+            capture_output=True, text=True, check=True).stdout)
+            for _ in range(repeat))
+    return pd.Series(results, name='import seconds')
+
+
+def benchmark_loaders(data_dir, factor=100):
+    """ Compare reading and cleaning profile.json and portfolio.json with
+    prepare_profile and prepare_portfolio and with the typed loaders, on
+    the files repeated a number of times
+    Input:
+    - data_dir: folder with portfolio.json and profile.json
+    - factor: number of times the lines of the files are repeated
+    Output:
+    - results: dataframe with the seconds of each method per dataset
+    """
+    read = lambda path: pd.read_json(path, orient='records', lines=True)
+    methods = {'profile': (prepare_profile, load_profile),
+               'portfolio': (prepare_portfolio, load_portfolio)}
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, (prepare, load) in methods.items():
+            with open(os.path.join(data_dir, '{}.json'.format(name))) as f:
+                lines = [l for l in f if l.strip()]
+            path = os.path.join(tmp, '{}.json'.format(name))
+            with open(path, 'w') as f:
+                f.writelines(lines * factor)
+            results.append({
+                'dataset': name, 'rows': len(lines) * factor,
+                'read_json + prepare': time_function(
+                    lambda: prepare(read(path)), repeat=1),
+                'typed loader': time_function(load, path, repeat=1)})
+    return pd.DataFrame(results).set_index('dataset')
+
+
+def measure(func, *args):
+    """ Run a function and measure its wall time and peak memory. The peak
+    memory comes from a second, traced run, so that tracing doesn't slow
+    down the timed one.
+    Input:
+    - func: function to be measured
+    - args: arguments of the function
+    Output:
+    - (result, seconds, peak_mb): result of the function, wall time and
+    peak of the memory allocated during the call in MB
+    """
+    start = time.perf_counter()
+    result = func(*args)
+    seconds = time.perf_counter() - start
+    del result
+    tracemalloc.start()
+    result = func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak / 2**20
+
+
+def benchmark_pipeline(data_dir):
+    """ Measure every stage of the pipeline, from the json files to the
+    recommendations
+    Input:
+    - data_dir: folder with portfolio.json, profile.json and transcript.json
+    Output:
+    - results: dataframe with the wall time, peak memory and output rows
+    of each stage
+    """
+    path = lambda name: os.path.join(data_dir, '{}.json'.format(name))
+    read = lambda name: pd.read_json(path(name), orient='records',
+                                     lines=True)
+    results = []
+
+    def stage(name, func, *args):
+        result, seconds, peak = measure(func, *args)
+        results.append({'stage': name, 'seconds': seconds, 'peak_mb': peak,
+                        'rows': len(result)})
+        return result
+
+    portfolio = stage('read portfolio', read, 'portfolio')
+    profile = stage('read profile', read, 'profile')
+    transcript = stage('read transcript', read, 'transcript')
+    portfolio = stage('prepare_portfolio', prepare_portfolio, portfolio)
+    profile = stage('prepare_profile', prepare_profile, profile)
+    stage('load_portfolio', load_portfolio, path('portfolio'))
+    stage('load_profile', load_profile, path('profile'))
+    transcript = stage('prepare_transcript', prepare_transcript, transcript)
+    stage('load_transcript', load_transcript, path('transcript'))
+    df = stage('merge_datasets', merge_datasets, portfolio, profile,
+               transcript)
+    del transcript
+    stage('merge_datasets compact', merge_datasets, portfolio, profile,
+          load_transcript(path('transcript')), True)
+    stage('attribute_transactions', attribute_transactions, df)
+    stage('per_customer_data', per_customer_data, df, profile)
+    customers = stage('per_customer_data_fast', per_customer_data_fast, df,
+                      profile)
+    stage('get_most_popular_offers', get_most_popular_offers, customers, 10)
+    stage('get_most_popular_offers_filtered',
+          get_most_popular_offers_filtered, customers, 10, 0.5, 72000, 35,
+          'F')
+    index = stage('build_segment_index', build_segment_index, customers)
+    stage('bootstrap_segment_index', bootstrap_segment_index, index)
+    stage('get_most_popular_offers_batch', get_most_popular_offers_batch,
+          customers, profile, 2)
+    return pd.DataFrame(results).set_index('stage')
+
+
+def save_results(results, path, **info):
+    """ Append benchmark results to a json-lines file, together with the
+    current commit, so that runs of different commits can be compared
+    Input:
+    - results: dataframe returned by benchmark_pipeline
+    - path: json-lines file
+    - info: other fields to be saved, e.g. the scale of the data
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                                capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ''
+    record = {'commit': commit, 'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'stages': results.reset_index().to_dict(orient='records')}
+    record.update(info)
+    with open(path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def load_results(path):
+    """ Load the results saved with save_results
+    Input:
+    - path: json-lines file
+    Output:
+    - results: dataframe with one row per commit, scale and stage
+    """
+    records = pd.read_json(path, orient='records', lines=True)
+    stages = records.explode('stages').reset_index(drop=True)
+    results = pd.concat([stages.drop(columns='stages'),
+                         pd.DataFrame(stages.stages.tolist())], axis=1)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the pipeline on synthetic data')
+    parser.add_argument('--scale', type=float, nargs='+', default=[1])
+    parser.add_argument('--data-dir', default=None,
+                        help='benchmark these files instead of synthetic data')
+    parser.add_argument('--results', default='benchmark_results.jsonl')
+    parser.add_argument('--compare', action='store_true',
+                        help='also compare the alternative implementations')
+    args = parser.parse_args()
+
+    if args.data_dir:
+        runs = [(None, args.data_dir)]
+    else:
+        tmp = tempfile.TemporaryDirectory()
+        runs = [(scale, os.path.join(tmp.name, str(scale)))
+                for scale in args.scale]
+    for scale, data_dir in runs:
+        if scale is not None:
+            generate_datasets(data_dir, scale)
+        results = benchmark_pipeline(data_dir)
+        save_results(results, args.results, scale=scale)
+        print('scale: {}'.format(scale))
+        print(results)
+
+    if args.compare:
+        portfolio = pd.read_json(os.path.join(data_dir, 'portfolio.json'),
+                                 orient='records', lines=True)
+        profile = pd.read_json(os.path.join(data_dir, 'profile.json'),
+                               orient='records', lines=True)
+        portfolio = prepare_portfolio(portfolio)
+        profile = prepare_profile(profile)
+        transcript = load_transcript(os.path.join(data_dir, 'transcript.json'))
+        data = merge_datasets(portfolio, profile, transcript)
+
+        print(benchmark_per_customer_data(data, profile))
+        print(benchmark_parallel(data, profile))
+        print(benchmark_attribution(data, profile))
+        customers = per_customer_data_fast(data, profile)
+        print(benchmark_recommendations(customers, profile))
+        print(benchmark_import_time())
+        print(benchmark_loaders(data_dir))
@@ -0,0 +1,253 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from recommendations import OFFERS
+
+SIGNALS = ['viewed', 'completed', 'net_expense']
+# Informational offers can't be completed, their views are used instead, as
+# in net_expense_flag
+INFORMATIONAL = ['I1', 'I2']
+
+
+def signal_matrix(viewed, completed, net_expense, total_transactions,
+                  signal='net_expense'):
+    """ Build the customer x offer matrix of a signal from the viewed and
+    completed counts
+    Input:
+    - viewed: sparse matrix with the views per customer and offer
+    - completed: sparse matrix with the completions per customer and offer
+    - net_expense: array with the net_expense of every customer
+    - total_transactions: array with the transactions of every customer
+    - signal: 'viewed', 'completed' or 'net_expense', the net_expense of
+    the customers that get_net_expense considers for the offer
+    Returns:
+    - csr matrix of floats
+    """
+    if signal not in SIGNALS:
+        raise ValueError('Unknown signal {}, use one of {}'.format(signal,
+                                                                  SIGNALS))
+    viewed = sp.csr_matrix(viewed, dtype=float)
+    if signal == 'viewed':
+        return viewed
+    informational = np.isin(OFFERS, INFORMATIONAL).astype(float)
+    completed = sp.csr_matrix(completed, dtype=float)
+    completed = completed + viewed @ sp.diags(informational)
+    if signal == 'completed':
+        return completed
+    # Offers both viewed and completed by customers with a positive
+    # net_expense and at least 5 transactions
+    eligible = (net_expense > 0) & (total_transactions >= 5)
+    both = viewed.minimum(1).multiply(completed.minimum(1))
+    weights = np.where(eligible, net_expense, 0)
+    return sp.csr_matrix(sp.diags(weights) @ both)
+
+
+def interaction_matrix(customers, signal='net_expense'):
+    """ Build the customer x offer matrix of a signal from the aggregated
+    data per customer
+    Input:
+    - customers: dataframe with aggregated data of the offers
+    - signal: 'viewed', 'completed' or 'net_expense'
+    Returns:
+    - (matrix, customer_ids): csr matrix with one row per customer and
+    one column per offer of OFFERS, and the customer of every row
+    """
+    viewed = customers[['{}_viewed'.format(o) for o in OFFERS]].values
+    completed = np.column_stack([
+        np.zeros(len(customers)) if o in INFORMATIONAL
+        else customers['{}_completed'.format(o)].values for o in OFFERS])
+    matrix = signal_matrix(sp.csr_matrix(viewed), sp.csr_matrix(completed),
+                           customers.net_expense.values,
+                           customers.total_transactions.values, signal)
+    return matrix, customers.index
+
+
+def interaction_matrix_from_df(df, signal='net_expense'):
+    """ Build the customer x offer matrix of a signal directly from the
+    merged dataframe, without aggregating every column of per_customer_data
+    Input:
+    - df: merged dataframe with transactions, customer and offer data
+    - signal: 'viewed', 'completed' or 'net_expense'
+    Returns:
+    - (matrix, customer_ids): csr matrix with one row per customer and
+    one column per offer of OFFERS, and the customer of every row
+    """
+    customer_ids = pd.Index(np.sort(df.customer_id.unique()))
+    rows = customer_ids.get_indexer(df.customer_id)
+    cols = pd.Index(OFFERS).get_indexer(df.offer_id.astype(object))
+    shape = (len(customer_ids), len(OFFERS))
+
+    def count(event):
+        flag = (df[event].values == 1) & (cols >= 0)
+        return sp.csr_matrix((np.ones(flag.sum()), (rows[flag], cols[flag])),
+                             shape=shape)
+
+    transaction = df.event_transaction.values == 1
+    total_expense = np.bincount(rows[transaction],
+                                np.nan_to_num(df.amount.values[transaction]),
+                                minlength=shape[0])
+    total_transactions = np.bincount(rows[transaction], minlength=shape[0])
+    completed = df.event_offer_completed.values == 1
+    reward = np.bincount(rows[completed], df.reward.values[completed],
+                         minlength=shape[0])
+    matrix = signal_matrix(count('event_offer_viewed'),
+                           count('event_offer_completed'),
+                           total_expense - reward, total_transactions,
+                           signal)
+    return matrix, customer_ids
+
+
+def normalize_rows(matrix):
+    """ Scale the rows of a sparse matrix to unit length, rows of zeros
+    stay zero
+    Input:
+    - matrix: sparse matrix
+    Returns:
+    - csr matrix
+    """
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1))).ravel()
+    return sp.csr_matrix(sp.diags(1 / np.where(norms > 0, norms, 1)) @ matrix)
+
+
+def item_similarity(matrix, block_size=100000):
+    """ Cosine similarity between the offers, accumulating the offer x
+    offer products over blocks of customers, so the memory does not grow
+    with the number of customers
+    Input:
+    - matrix: customer x offer sparse matrix
+    - block_size: number of customers per block
+    Returns:
+    - dense offer x offer similarity matrix, with zeros in the diagonal
+    """
+    matrix = sp.csr_matrix(matrix)
+    gram = np.zeros((matrix.shape[1], matrix.shape[1]))
+    for start in range(0, matrix.shape[0], block_size):
+        block = matrix[start:start + block_size]
+        gram += (block.T @ block).toarray()
+    norms = np.sqrt(np.diag(gram))
+    norms = np.where(norms > 0, norms, 1)
+    similarity = gram / np.outer(norms, norms)
+    np.fill_diagonal(similarity, 0)
+    return similarity
+
+
+def item_scores(matrix, similarity=None, block_size=100000):
+    """ Score every offer for every customer as the sum of the similarity
+    of the offer with the offers of the customer, weighted by the signal
+    Input:
+    - matrix: customer x offer sparse matrix
+    - similarity: offer x offer similarity (default: item_similarity)
+    - block_size: number of customers per block
+    Returns:
+    - generator of (start, scores) tuples, with the first row of every
+    block of customers and its dense scores
+    """
+    matrix = sp.csr_matrix(matrix)
+    if similarity is None:
+        similarity = item_similarity(matrix, block_size)
+    for start in range(0, matrix.shape[0], block_size):
+        yield start, np.asarray(matrix[start:start + block_size] @
+                                similarity)
+
+
+def neighbor_scores(matrix, k=50, max_cells=2**24):
+    """ Score every offer for every customer as the signal of the k most
+    similar customers (cosine), weighted by their similarity. The
+    similarity is computed for blocks of customers against all of them,
+    with at most max_cells similarities in memory at once. The time grows
+    with the square of the number of customers, use item_scores for
+    millions of customers.
+    Input:
+    - matrix: customer x offer sparse matrix
+    - k: number of neighbors
+    - max_cells: maximum size of a block of the similarity matrix
+    Returns:
+    - generator of (start, scores) tuples, with the first row of every
+    block of customers and its dense scores
+    """
+    matrix = sp.csr_matrix(matrix)
+    normalized = normalize_rows(matrix)
+    n = matrix.shape[0]
+    k = min(k, n - 1)
+    block_size = max(1, max_cells // max(n, 1))
+    for start in range(0, n, block_size):
+        rows = np.arange(start, min(start + block_size, n))
+        similarity = (normalized[rows] @ normalized.T).toarray()
+        # A customer is not its own neighbor
+        similarity[np.arange(len(rows)), rows] = -np.inf
+        if k <= 0:
+            yield start, np.zeros((len(rows), matrix.shape[1]))
+            continue
+        neighbors = np.argpartition(-similarity, k - 1, axis=1)[:, :k]
+        weights = np.take_along_axis(similarity, neighbors, axis=1)
+        weights = np.maximum(weights, 0)
+        weights = sp.csr_matrix((weights.ravel(), neighbors.ravel(),
+                                 np.arange(0, len(rows) * k + 1, k)),
+                                shape=(len(rows), n))
+        yield start, np.asarray((weights @ matrix).toarray())
+
+
+def top_n(scores, popularity, n_top=2, seen=None):
+    """ Get the offers with the highest scores of every row. Ties, e.g.
+    customers without interactions, are broken by the popularity of the
+    offers.
+    Input:
+    - scores: dense customer x offer scores
+    - popularity: popularity of every offer
+    - n_top: number of offers per row
+    - seen: boolean matrix of offers to be left out (optional)
+    Returns:
+    - matrix with the column of the top offers of every row, -1 where a
+    row has fewer than n_top offers left
+    """
+    scores = np.array(scores, dtype=float)
+    if seen is not None:
+        scores[seen] = -np.inf
+    popularity = np.broadcast_to(popularity, scores.shape)
+    # lexsort uses the last key as the primary one
+    order = np.lexsort((-popularity, -scores), axis=-1)[:, :n_top]
+    left = np.take_along_axis(scores, order, axis=1) > -np.inf
+    order = np.where(left, order, -1)
+    return np.pad(order, ((0, 0), (0, n_top - order.shape[1])),
+                  constant_values=-1)
+
+
+def recommend_batch(matrix, customer_ids, n_top=2, method='item', k=50,
+                    exclude_seen=False, block_size=100000, max_cells=2**24):
+    """ Get the top offers of every customer of an interaction matrix at
+    once, block by block
+    Input:
+    - matrix: customer x offer sparse matrix
+    - customer_ids: customer of every row
+    - n_top: number of offers to be returned (default: 2)
+    - method: 'item' for item-item scores, 'neighbors' for the scores of
+    the most similar customers
+    - k: number of neighbors of the 'neighbors' method
+    - exclude_seen: leave out the offers a customer already has a signal of
+    - block_size: number of customers per block of the 'item' method
+    - max_cells: maximum size of a block of the customer similarity matrix
+    of the 'neighbors' method
+    Returns:
+    - dataframe indexed by customer_id, with the columns offer_1 to
+    offer_<n_top>, None where there are no offers left
+    """
+    matrix = sp.csr_matrix(matrix)
+    if method == 'item':
+        blocks = item_scores(matrix, block_size=block_size)
+    elif method == 'neighbors':
+        blocks = neighbor_scores(matrix, k, max_cells)
+    else:
+        raise ValueError("Unknown method {}, use 'item' or "
+                         "'neighbors'".format(method))
+    popularity = np.asarray((matrix > 0).sum(axis=0)).ravel()
+    offers = np.array(OFFERS + [None], dtype=object)
+    top = []
+    for start, scores in blocks:
+        seen = None
+        if exclude_seen:
+            seen = (matrix[start:start + len(scores)] > 0).toarray()
+        top.append(offers[top_n(scores, popularity, n_top, seen)])
+    columns = ['offer_{}'.format(i + 1) for i in range(n_top)]
+    top = np.concatenate(top) if top else np.empty((0, n_top), dtype=object)
+    return pd.DataFrame(top, index=pd.Index(customer_ids, name='customer_id'),
+                        columns=columns)
@@ -0,0 +1,118 @@
+import os
+import re
+import shutil
+import hashlib
+import tempfile
+import pandas as pd
+import pyarrow.feather as feather
+from data_preprocessing import *
+from data_loaders import load_portfolio, load_profile
+from eda import per_customer_data_fast
+
+# Bump when the cleaning or aggregation code changes the cached frames
+CACHE_VERSION = 2
+DATASETS = ['portfolio', 'profile', 'transcript', 'df', 'customers']
+
+
+def source_hash(paths):
+    """ Hash the content of the source files together with the cache version
+    Input:
+    - paths: list of source file paths
+    Returns:
+    - hex digest identifying the cached datasets
+    """
+    sha = hashlib.sha256('v{}'.format(CACHE_VERSION).encode())
+    for path in paths:
+        sha.update(os.path.basename(path).encode())
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+    return sha.hexdigest()
+
+
+def data_dir_key(data_dir):
+    """ Name of the cache subfolder of a data folder, so that the caches of
+    different data folders in the same cache_dir don't evict each other
+    Input:
+    - data_dir: folder with the json files
+    Returns:
+    - hex digest of the absolute path of the folder
+    """
+    path = os.path.abspath(data_dir)
+    return hashlib.sha256(path.encode()).hexdigest()[:16]
+
+
+def write_frame(frame, path):
+    """ Store a dataframe as an uncompressed feather file, so that it can be
+    memory-mapped when it is read back
+    Input:
+    - frame: dataframe to be stored
+    - path: destination file
+    """
+    feather.write_feather(frame, path, compression='uncompressed')
+
+
+def read_frame(path):
+    """ Read a dataframe stored with write_frame through a memory map
+    Input:
+    - path: feather file
+    Returns:
+    - frame: stored dataframe
+    """
+    table = feather.read_table(path, memory_map=True)
+    return table.to_pandas(split_blocks=True)
+
+
+def load_datasets(data_dir='data', cache_dir='data/cache', chunksize=100000):
+    """ Load the cleaned datasets, the merged dataframe and the aggregated
+    customers data. They are built from the json files the first time and
+    read from the cache afterwards, until the json files change.
+    Input:
+    - data_dir: folder with portfolio.json, profile.json and transcript.json
+    - cache_dir: folder where the cached datasets are stored, in a
+    subfolder per data folder
+    - chunksize: number of transcript lines parsed at once
+    Returns:
+    - (portfolio, profile, transcript, df, customers): tuple with the datasets
+    """
+    paths = {name: os.path.join(data_dir, '{}.json'.format(name))
+             for name in ['portfolio', 'profile', 'transcript']}
+    key = source_hash(paths.values())
+    cache_dir = os.path.join(cache_dir, data_dir_key(data_dir))
+    folder = os.path.join(cache_dir, key)
+    files = [os.path.join(folder, '{}.feather'.format(d)) for d in DATASETS]
+    if all(os.path.exists(f) for f in files):
+        data = [read_frame(f) for f in files]
+        data[-1].set_index('customer_id', inplace=True)
+        return tuple(data)
+
+    portfolio = load_portfolio(paths['portfolio'])
+    profile = load_profile(paths['profile'])
+    transcript = load_transcript(paths['transcript'], chunksize)
+    df = merge_datasets(portfolio, profile, transcript)
+    customers = per_customer_data_fast(df, profile)
+    data = (portfolio, profile, transcript, df, customers)
+
+    # Write to a temporary folder of its own first, so a failed run never
+    # leaves a partial cache behind and concurrent runs don't collide
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=cache_dir)
+    try:
+        for frame, name in zip(data, DATASETS):
+            if name == 'customers':
+                frame = frame.reset_index()
+            write_frame(frame, os.path.join(tmp, '{}.feather'.format(name)))
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    # Drop the entries of older source files of the same data folder
+    for entry in os.listdir(cache_dir):
+        if re.fullmatch('[0-9a-f]{64}', entry) and entry != key:
+            shutil.rmtree(os.path.join(cache_dir, entry), ignore_errors=True)
+    try:
+        os.replace(tmp, folder)
+    except OSError:
+        # Another run stored the same datasets first
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    return data
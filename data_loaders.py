@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+
+# Types of the fields of the json files, read as they are stored
+PORTFOLIO_DTYPES = {'reward': np.int64, 'channels': object,
+                    'difficulty': np.int64, 'duration': np.int64,
+                    'offer_type': object, 'id': object}
+PROFILE_DTYPES = {'gender': object, 'age': np.int64, 'id': object,
+                  'became_member_on': str, 'income': np.float64}
+
+
+def read_json_lines(path, dtypes):
+    """ Read a json-lines file with the given column types, without the
+    type and date inference of read_json
+    Input:
+    - path: json-lines file
+    - dtypes: dict from column to type, in the order of the columns
+    Returns:
+    - dataframe with the columns of dtypes
+    """
+    data = pd.read_json(path, orient='records', lines=True, dtype=False,
+                        convert_dates=False)
+    return data[[*dtypes]].astype(dtypes)
+
+
+def channel_dummies(channels):
+    """ Build the channel_<name> indicator columns from the lists of
+    channels. Every list is encoded as a bitmask with one bit per channel,
+    and the columns are the bits of the masks.
+    Input:
+    - channels: series of lists of channels
+    Returns:
+    - dataframe with one uint8 column per channel, sorted by name
+    """
+    names = sorted({c for row in channels for c in row})
+    bits = {c: 1 << i for i, c in enumerate(names)}
+    masks = np.array([sum(bits[c] for c in set(row)) for row in channels],
+                     dtype=np.int64)
+    return pd.DataFrame({'channel_{}'.format(c): ((masks >> i) & 1)
+                         .astype(np.uint8) for i, c in enumerate(names)},
+                        index=channels.index)
+
+
+def load_portfolio(path):
+    """ Read portfolio.json and clean it like prepare_portfolio
+    Input:
+    - path: portfolio json-lines file
+    Returns:
+    - portfolio_clean
+    """
+    portfolio = read_json_lines(path, PORTFOLIO_DTYPES)
+    portfolio_clean = pd.concat([portfolio.drop(columns='channels'),
+                                 channel_dummies(portfolio.channels)], axis=1)
+    portfolio_clean.rename(columns={'id': 'offer_id'}, inplace=True)
+    return portfolio_clean
+
+
+def load_profile(path):
+    """ Read profile.json and clean it like prepare_profile
+    Input:
+    - path: profile json-lines file
+    Returns:
+    - profile_clean
+    """
+    profile_clean = read_json_lines(path, PROFILE_DTYPES)
+    profile_clean['became_member_on'] = pd.to_datetime(
+        profile_clean.became_member_on, format='%Y%m%d')
+    profile_clean['valid'] = (profile_clean.age != 118).astype(np.int64)
+    profile_clean.rename(columns={'id': 'customer_id'}, inplace=True)
+    dummy_gender = pd.get_dummies(profile_clean.gender, prefix='gender',
+                                  dtype=np.uint8)
+    return pd.concat([profile_clean, dummy_gender], axis=1, sort=False)
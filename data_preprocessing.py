@@ -1,10 +1,23 @@
 import math
+from itertools import islice
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib
+from instrumentation import instrument
 
+# Simplified names of the offer ids
+OFFER_NAMES = {'ae264e3637204a6fb9bb56bc8210ddfd': 'B1',
+               '4d5c57ea9a6940dd891ad53e9dbe8da0': 'B2',
+               '9b98b8c7a33c4b65b9aebfe6a799e6d9': 'B3',
+               'f19421c1d4aa40978ebb69ca19b0e20d': 'B4',
+               '0b1e1539f2cc45b7b9fa7c272da2e1d7': 'D1',
+               '2298d6c36e964ae4a3e7e9706d1fb8c2': 'D2',
+               'fafdcd668e3743c1bb461111dcafc2a4': 'D3',
+               '2906b810c7d4411798c6938adc9daaa5': 'D4',
+               '3f207df678b143eea3cee63160fa8bed': 'I1',
+               '5a8bc65990b245e5a138643cd4eb9837': 'I2'}
 
+
+@instrument
 def prepare_portfolio(portfolio):
     """ 
     - It makes columns for the channels
@@ -17,7 +30,7 @@ def prepare_portfolio(portfolio):
     portfolio_clean = portfolio.copy()
     # Create dummy columns for the channels column
     d_chann = pd.get_dummies(portfolio_clean.channels.apply(pd.Series).stack(),
-                             prefix="channel").sum(level=0)
+                             prefix="channel").groupby(level=0).sum()
     portfolio_clean = pd.concat([portfolio_clean, d_chann], axis=1, sort=False)
     portfolio_clean.drop(columns='channels', inplace=True)
     # Change column name
@@ -26,6 +39,7 @@ def prepare_portfolio(portfolio):
     return portfolio_clean
 
 
+@instrument
 def prepare_profile(profile):
     """ 
     - Fix the date format
@@ -51,6 +65,7 @@ def prepare_profile(profile):
     return profile_clean
 
 
+@instrument
 def prepare_transcript(transcript):
     """ .
     - Split value in several columns for offers and transactions
@@ -82,29 +97,187 @@ def prepare_transcript(transcript):
     transcript_clean.rename(columns={'person':'customer_id'}, inplace=True)
     return transcript_clean
 
-def merge_datasets(portfolio_clean, profile_clean, transcript_clean):
+
+def stream_transcript(path, chunksize=100000):
+    """ Read the transcript json-lines file in chunks and yield each chunk
+    with the same columns as prepare_transcript. The fields are extracted
+    directly from the raw lines, without parsing the value dicts.
+    Input:
+    - path: path of the transcript json-lines file
+    - chunksize: number of lines per chunk
+    Returns:
+    - generator of transcript_clean chunks
+    """
+    with open(path) as f:
+        while True:
+            lines = pd.Series(list(islice(f, chunksize)), dtype=object)
+            if lines.empty:
+                break
+            # Skip blank lines, e.g. a trailing newline at the end of the file
+            lines = lines[lines.str.strip() != ''].reset_index(drop=True)
+            yield parse_transcript_lines(lines)
+
+
+def parse_transcript_lines(lines):
+    """ Build a transcript_clean chunk from raw transcript json lines,
+    with or without whitespace around the colons
+    Input:
+    - lines: series with one json record per element
+    Returns:
+    - transcript_clean chunk
+    """
+    chunk = pd.DataFrame()
+    chunk['customer_id'] = lines.str.extract(r'"person"\s*:\s*"([^"]*)"',
+                                             expand=False)
+    chunk['time'] = lines.str.extract(r'"time"\s*:\s*(\d+)',
+                                      expand=False).astype(np.int64)
+    # Create the same dummy columns for every chunk, even if an event
+    # does not show up in it
+    event = lines.str.extract(r'"event"\s*:\s*"([^"]*)"', expand=False)
+    for e in ['offer completed', 'offer received', 'offer viewed',
+              'transaction']:
+        chunk['event_' + e.replace(' ', '_')] = (event == e).astype(np.uint8)
+    offer_id = lines.str.extract(r'"offer[ _]id"\s*:\s*"([^"]*)"',
+                                 expand=False)
+    chunk['offer_id'] = offer_id.where(offer_id.notnull(), None)
+    amount = lines.str.extract(r'"amount"\s*:\s*([^,}\s]+)', expand=False)
+    chunk['amount'] = amount.astype(float).round(2)
+    return chunk
+
+
+@instrument
+def load_transcript(path, chunksize=100000):
+    """ Load the transcript json-lines file chunk by chunk, so the raw
+    records are never held in memory all at once
+    Input:
+    - path: path of the transcript json-lines file
+    - chunksize: number of lines per chunk
+    Returns:
+    - transcript_clean
+    """
+    return pd.concat(stream_transcript(path, chunksize), ignore_index=True)
+
+def compact_profile(profile_clean):
+    """ Compact version of the cleaned profile dataset
+    - Replace customer_id with the row number of the customer
+    - Store gender as a category and the dummy columns as uint8
+    - Store age and income with smaller dtypes
+    Input:
+    - profile_clean
+    Returns:
+    - profile_compact
+    """
+    profile_compact = profile_clean.copy()
+    profile_compact['customer_id'] = np.arange(len(profile_clean),
+                                               dtype=np.int32)
+    profile_compact['gender'] = profile_compact.gender.astype('category')
+    dummies = ['valid'] + [c for c in profile_compact.columns
+                           if c.startswith('gender_')]
+    profile_compact[dummies] = profile_compact[dummies].astype(np.uint8)
+    profile_compact['age'] = profile_compact.age.astype(np.int16)
+    profile_compact['income'] = profile_compact.income.astype(np.float32)
+    return profile_compact
+
+
+@instrument
+def merge_datasets(portfolio_clean, profile_clean, transcript_clean,
+                   compact=False):
     """ Merge the three data sets into one
     Input:
     - portfolio_clean
     - profile_clean
     - transcript_clean
+    - compact: if True, customer_id is replaced with the row number of the
+    customer in profile_clean (-1 if it is not there), offer_id, offer_type
+    and gender are categories, the dummy columns are uint8 and the float
+    columns are float32. Use compact_profile(profile_clean) as the profile
+    of per_customer_data in that case.
     Output:
     - df: merged dataframe
     """
+    if compact:
+        customer_ids = pd.Index(profile_clean.customer_id)
+        customer_codes = customer_ids.get_indexer(transcript_clean.customer_id)
+        transcript_clean = transcript_clean.assign(
+            customer_id=customer_codes.astype(np.int32))
+        profile_clean = compact_profile(profile_clean)
     trans_prof = pd.merge(transcript_clean, profile_clean, on='customer_id',
                           how="left")
     df = pd.merge(trans_prof, portfolio_clean, on='offer_id', how='left')
     # Change the offer ids to a simplied form
-    offer_id = {'ae264e3637204a6fb9bb56bc8210ddfd': 'B1',
-                '4d5c57ea9a6940dd891ad53e9dbe8da0': 'B2',
-                '9b98b8c7a33c4b65b9aebfe6a799e6d9': 'B3',
-                'f19421c1d4aa40978ebb69ca19b0e20d': 'B4',
-                '0b1e1539f2cc45b7b9fa7c272da2e1d7': 'D1',
-                '2298d6c36e964ae4a3e7e9706d1fb8c2': 'D2',
-                'fafdcd668e3743c1bb461111dcafc2a4': 'D3',
-                '2906b810c7d4411798c6938adc9daaa5': 'D4',
-                '3f207df678b143eea3cee63160fa8bed': 'I1',
-                '5a8bc65990b245e5a138643cd4eb9837': 'I2'}
-    df.offer_id = df.offer_id.apply(lambda x: offer_id[x] if x else None)
-
-    return df
\ No newline at end of file
+    offer_id = OFFER_NAMES
+    if not compact:
+        df.offer_id = df.offer_id.apply(lambda x: offer_id[x] if x else None)
+        return df
+
+    df['offer_id'] = pd.Categorical(df.offer_id, categories=[*offer_id])
+    df['offer_id'] = df.offer_id.cat.rename_categories(offer_id)
+    df['offer_type'] = df.offer_type.astype('category')
+    channels = [c for c in df.columns if c.startswith('channel_')]
+    df[channels] = df[channels].fillna(0).astype(np.uint8)
+    floats = ['amount', 'reward', 'difficulty', 'duration']
+    df[floats] = df[floats].astype(np.float32)
+
+    return df
+
+
+@instrument
+def attribute_transactions(df):
+    """ Tag each transaction with the offer that influenced it: among the
+    offers viewed before the transaction that had not expired yet (time
+    received + duration), the one viewed most recently.
+    Input:
+    - df: merged dataframe
+    Output:
+    - df_attr: merged dataframe with the column attributed_offer_id, which
+    is None for transactions without an offer and for offer events
+    """
+    received = df.loc[df.event_offer_received == 1,
+                      ['customer_id', 'offer_id', 'time', 'duration']]
+    received = received.rename(columns={'time': 'received_time'})
+    viewed = df.loc[df.event_offer_viewed == 1,
+                    ['customer_id', 'offer_id', 'time']]
+    # Match every view with the latest reception of the same offer
+    views = pd.merge_asof(viewed.sort_values('time'),
+                          received.sort_values('received_time'),
+                          left_on='time', right_on='received_time',
+                          by=['customer_id', 'offer_id'])
+    views['expires'] = views.received_time + views.duration * 24
+    views = views[views.time <= views.expires]
+    views = views.rename(columns={'time': 'viewed_time',
+                                  'offer_id': 'attributed_offer_id'})
+
+    # Match every transaction with the latest view of the same customer
+    # whose offer is still open: start from the latest view before the
+    # transaction and step back through the earlier views of the customer
+    # while the offer of the view has expired
+    transactions = df.loc[df.event_transaction == 1, ['customer_id', 'time']]
+    customers = pd.Index(pd.unique(pd.concat([views.customer_id,
+                                              transactions.customer_id])))
+    views = views.assign(code=customers.get_indexer(views.customer_id))
+    views = views.sort_values(['code', 'viewed_time'], kind='stable')
+    view_code = views.code.values
+    view_time = views.viewed_time.values.astype(np.int64)
+    expires = views.expires.values
+    code = customers.get_indexer(transactions.customer_id)
+    time = transactions.time.values.astype(np.int64)
+    # Sort key of (customer, time) pairs
+    span = int(np.max(np.concatenate([time, view_time, [0]]))) + 1
+    position = np.searchsorted(view_code * span + view_time,
+                               code * span + time, side='right') - 1
+    open_view = np.zeros(len(time), dtype=bool)
+    pending = position >= 0
+    while pending.any():
+        same = np.zeros(len(time), dtype=bool)
+        same[pending] = view_code[position[pending]] == code[pending]
+        found = same & (expires[np.maximum(position, 0)] >= time)
+        open_view |= found
+        # The search ends at the first view of the customer
+        pending = same & ~found & (position > 0)
+        position = np.where(pending, position - 1, position)
+
+    df_attr = df.copy()
+    df_attr['attributed_offer_id'] = None
+    df_attr.loc[transactions.index[open_view], 'attributed_offer_id'] = \
+        views.attributed_offer_id.astype(object).values[position[open_view]]
+    return df_attr
@@ -1,9 +1,21 @@
+import os
 import math
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib
-
+from instrumentation import instrument
+
+EVENTS = ['received', 'viewed', 'completed']
+OFFER_TYPES = ['bogo', 'discount', 'informational']
+OFFER_IDS = ['B1', 'B2', 'B3', 'B4', 'D1', 'D2', 'D3', 'D4', 'I1', 'I2']
+# Lower edges of the age and income groups, plus the upper limit of the last one
+AGE_EDGES = np.arange(15, 116, 10)
+INCOME_EDGES = np.arange(30000, 130001, 10000)
+SEGMENT_LEVELS = ['age_group', 'income_group', 'gender']
+COHORT_STATS = ['total_expense', 'total_transactions', 'net_expense']
+
+@instrument
 def per_customer_data(df, profile):
     """ Build a dataframe with aggregated purchase and offer data and demographics
     Input:
@@ -29,15 +41,206 @@ def per_customer_data(df, profile):
     customers.columns = cust_dict.keys()
     customers.fillna(0, inplace=True)
 
-    # Add demographic data
+    return add_demographics(customers, profile)
+
+
+@instrument
+def per_customer_data_fast(df, profile):
+    """ Build the same dataframe as per_customer_data, but from a single
+    grouped pass over the offer events instead of one pass per offer,
+    offer type and event
+    Input:
+    - df: merged dataframe with transactions, customer and offer data
+    - profile: cleaned profile dataset
+    Output:
+    - customer: dataframe with aggregated data
+    """
+    return add_demographics(order_customers(aggregate_customers(df)), profile)
+
+
+def per_customer_data_parallel(df, profile, workers=None):
+    """ Build the same dataframe as per_customer_data_fast, aggregating
+    partitions of the customers in parallel processes. Each worker only
+    receives the events of its customers, the demographic data is added
+    once at the end.
+    Input:
+    - df: merged dataframe with transactions, customer and offer data
+    - profile: cleaned profile dataset
+    - workers: number of processes (default: number of cpus)
+    Output:
+    - customer: dataframe with aggregated data
+    """
+    workers = workers or os.cpu_count()
+    columns = ['customer_id', 'offer_type', 'offer_id', 'amount', 'reward',
+               'event_transaction'] + ['event_offer_{}'.format(e)
+                                       for e in EVENTS]
+    # Hash partition by customer, so every customer is in a single partition
+    hashes = pd.util.hash_pandas_object(df.customer_id, index=False).values
+    parts = [part for _, part in df[columns].groupby(hashes % workers)]
+    with ProcessPoolExecutor(workers) as pool:
+        partials = list(pool.map(aggregate_customers, parts))
+    customers = pd.concat(partials).sort_index()
+    return add_demographics(order_customers(customers), profile)
+
+
+def aggregate_customers(df):
+    """ Aggregate the transactions and the offer events per customer in a
+    single grouped pass
+    Input:
+    - df: merged dataframe with transactions, customer and offer data
+    Output:
+    - customers: dataframe with the aggregated columns of per_customer_data,
+    sorted by customer_id. It's NaN where a customer has no events.
+    """
+    # Get total transaction data
+    transactions = df[df.event_transaction == 1].groupby('customer_id').amount
+    totals = pd.concat([transactions.sum(), transactions.count()], axis=1,
+                       keys=['total_expense', 'total_transactions'])
+
+    # Label every offer event with its stage and aggregate all of them at once
+    events = df[df.event_transaction != 1]
+    event_cols = ['event_offer_{}'.format(e) for e in EVENTS]
+    stage = np.array(EVENTS)[events[event_cols].values.argmax(axis=1)]
+    grouped = events.groupby(['customer_id', 'offer_type', 'offer_id', stage],
+                             observed=True)
+    offer_data = grouped.agg(count=('offer_id', 'count'),
+                             reward=('reward', 'sum'))
+
+    # Roll the (customer, type, id, stage) cells up to every level and align
+    # them to the same customers
+    customer_ids = totals.index.union(offer_data.index.unique(level=0))
+    totals = totals.reindex(customer_ids)
+    overall = offer_data.groupby(level=[0, 3]).sum().unstack()
+    by_type = offer_data.groupby(level=[0, 1, 3]).sum().unstack([1, 2])
+    by_id = offer_data.groupby(level=[0, 2, 3]).sum().unstack([1, 2])
+    by_type = by_type.reindex(customer_ids)
+    by_id = by_id.reindex(customer_ids)
+    tables = [(None, overall.reindex(customer_ids))]
+    tables += [(ot, by_type) for ot in OFFER_TYPES]
+    tables += [(oi, by_id) for oi in OFFER_IDS]
+
+    data = {'total_expense': totals.total_expense,
+            'total_transactions': totals.total_transactions}
+    missing = pd.Series(np.nan, index=customer_ids)
+    for prefix, table in tables:
+        cell = lambda stat, e: (stat, prefix, e) if prefix else (stat, e)
+        # Informational offers don't have completed or reward data
+        no_completed = prefix in ['informational', 'I1', 'I2']
+        for e in EVENTS:
+            if no_completed and e == 'completed':
+                continue
+            key = '{}_{}'.format(prefix, e) if prefix else e
+            data[key] = table.get(cell('count', e), missing)
+        if not no_completed:
+            key = '{}_reward'.format(prefix) if prefix else 'reward'
+            data[key] = table.get(cell('reward', 'completed'), missing)
+    return pd.DataFrame({k: v.values for k, v in data.items()},
+                        index=customer_ids)
+
+
+def order_customers(customers):
+    """ Order the customers as the outer join of per_customer_data does: by
+    the first column they appear in, then by customer_id
+    Input:
+    - customers: output of aggregate_customers
+    Output:
+    - customers: ordered dataframe, with 0 where there are no events. The
+    counts are int64 where no customer is missing, like after the outer
+    joins of per_customer_data, the other columns are float.
+    """
+    present = customers.notnull()
+    counts = [key for key in customers.columns if present[key].all() and
+              key != 'total_expense' and not key.endswith('reward')]
+    for key in present.columns:
+        if key.endswith('reward'):
+            present[key] = present[key[:-len('reward')] + 'completed']
+    first_seen = present.values.argmax(axis=1)
+    customers = customers.iloc[np.argsort(first_seen, kind='stable')]
+    customers = customers.fillna(0).astype(float)
+    customers[counts] = customers[counts].astype(np.int64)
+    return customers
+
+
+def add_demographics(customers, profile):
+    """ Add the demographic data and the derived age, income and net
+    expense columns to the aggregated data per customer
+    Input:
+    - customers: dataframe with aggregated data per customer
+    - profile: cleaned profile dataset
+    Output:
+    - customers: dataframe with aggregated and demographic data
+    """
     customers = pd.merge(customers, profile.set_index('customer_id'),
                          left_index=True, right_index=True)
-    customers['age_group'] = customers.age.apply(round_age)
-    customers['income_group'] = customers.income.apply(round_income)
+    customers['age_group'] = round_age(customers.age)
+    customers['income_group'] = round_income(customers.income)
     customers['net_expense'] = customers['total_expense'] - customers['reward']
 
     return customers
 
+class CustomerAggregator:
+    """ Keep the aggregated data per customer up to date as new events
+    arrive. The counters of per_customer_data are sums, so a batch of new
+    events is aggregated on its own and added to the customers it touches.
+    Input:
+    - profile: cleaned profile dataset
+    - customers: aggregated data of the previous events (optional), it is
+    copied, so the caller's dataframe is left as it is
+    """
+    def __init__(self, profile, customers=None):
+        self.profile = profile
+        self.customers = None if customers is None else customers.copy()
+
+    def update(self, df_new):
+        """ Add a batch of new events
+        Input:
+        - df_new: merged dataframe with the new events only
+        Output:
+        - customers: copy of the updated dataframe with aggregated data,
+        later updates don't change it
+        """
+        partial = aggregate_customers(df_new)
+        if self.customers is None:
+            self.customers = add_demographics(order_customers(partial),
+                                              self.profile)
+            return self.customers.copy()
+
+        partial = partial.fillna(0)
+        counters = list(partial.columns)
+        known = partial.index.intersection(self.customers.index)
+        new = partial.index.difference(self.customers.index)
+        if len(known):
+            touched = self.customers.loc[known]
+            total = touched[counters].values + partial.loc[known].values
+            self.customers.loc[known, counters] = total
+            touched = self.customers.loc[known]
+            self.customers.loc[known, 'age_group'] = round_age(touched.age)
+            self.customers.loc[known, 'income_group'] = \
+                round_income(touched.income)
+            self.customers.loc[known, 'net_expense'] = \
+                touched.total_expense - touched.reward
+        if len(new):
+            added = add_demographics(partial.loc[new].astype(float),
+                                     self.profile)
+            self.customers = pd.concat([self.customers, added])
+        return self.customers.copy()
+
+    def verify(self, df):
+        """ Check that the updated data matches a full aggregation of all the
+        events. Customers may be in a different order, sums of amounts may
+        differ by rounding errors and counts may be float instead of int.
+        Input:
+        - df: merged dataframe with all the events applied so far
+        Raises:
+        - AssertionError if the data doesn't match
+        """
+        full = per_customer_data_fast(df, self.profile)
+        pd.testing.assert_frame_equal(self.customers.sort_index(),
+                                      full.sort_index(), check_exact=False,
+                                      check_dtype=False)
+
+
+@instrument
 def get_offer_cust(df, offer_type=None):
     """
     Get offer data (received, viewed and completed) per customer and
@@ -71,6 +274,7 @@ def get_offer_cust(df, offer_type=None):
     return data
 
 
+@instrument
 def get_offer_id_cust(df, offer_id):
     """
     Get offer data (received, viewed and completed) per customer
@@ -108,6 +312,8 @@ def plot_offer_expense(customers, offer):
     - customers: dataframe with aggregated data of the offers
     - offer: offer of interest
     """
+    # Loaded here, so the rest of the module works without matplotlib
+    import matplotlib.pyplot as plt
     rcv, vwd, cpd = get_offer_stat(customers, 'total_expense', offer)
     rcv_avg, vwd_avg, cpd_avg = get_average_expense(customers, offer)
 
@@ -136,14 +342,18 @@ def plot_offer_expense(customers, offer):
     plt.title('Average Transaction ($)')
     plt.grid();
 
-def plot_offer_expense_by(customers, offer):
+def plot_offer_expense_by(customers, offer, cube=None):
     """ Plot the total expense and the average expense per transaction
     incurred by customers that have received, viewed and completed an offer.
     The plots are separated by age, income and gender.
     Input:
     - customers: dataframe with aggregated data of the offers
     - offer: offer of interest
+    - cube: cohort cube of the customers (default: built for this offer)
     """
+    import matplotlib.pyplot as plt
+    if cube is None:
+        cube = cohort_cube(customers, [offer])
     rcv_by = dict()
     vwd_by = dict()
     cpd_by = dict()
@@ -155,8 +365,9 @@ def plot_offer_expense_by(customers, offer):
         rcv_by[key], vwd_by[key], cpd_by[key] = get_offer_stat_by(customers,
                                                                   'net_expense',
                                                                   offer, key,
-                                                                  aggr='mean')
-        by_data = get_average_expense_by(customers, offer, key)
+                                                                  aggr='mean',
+                                                                  cube=cube)
+        by_data = get_average_expense_by(customers, offer, key, cube)
         rcv_avg_by[key], vwd_avg_by[key], cpd_avg_by[key] = by_data
 
     plt.figure(figsize=(16, 10))
@@ -225,33 +436,53 @@ def plot_offer_expense_by(customers, offer):
     plt.title('Average Transaction Value');
     plt.xticks(index + bar_width, ('M', 'F', 'O'));
 
-def round_age(x):
+def bin_values(x, edges):
+    """
+    Round values down to the lower edge of their bin
+    Input:
+    - x: scalar, array or series of values
+    - edges: sorted bin edges, the last one is the upper limit of the last bin
+    Output:
+    - lower edge of the bin of each value, 0 if the value is out of range.
+    Same type as x.
+    """
+    edges = np.asarray(edges)
+    if np.ndim(x) == 0:
+        # A single value is faster to place without building arrays
+        pos = bisect_right(edges, x) - 1
+        return edges[pos].item() if 0 <= pos < len(edges) - 1 else 0
+    values = np.asarray(x, dtype=float)
+    pos = np.searchsorted(edges, values, side='right') - 1
+    in_range = (pos >= 0) & (pos < len(edges) - 1)
+    binned = np.where(in_range, edges[np.clip(pos, 0, len(edges) - 2)], 0)
+    if isinstance(x, pd.Series):
+        return pd.Series(binned, index=x.index, name=x.name)
+    return binned
+
+
+def round_age(x, edges=None):
     """
     Round age to the 5th of each 10th (15, 25,..., 105)
     Input:
-    - x: age
+    - x: age, as a scalar, array or series
+    - edges: bin edges (default: AGE_EDGES)
     Output:
     - rounded age. Returns 0 if the value is less than 15 or more than 105
     """
-    for y in range(15, 106, 10):
-        if x >= y and x < y+10:
-            return y
-    return 0
+    return bin_values(x, AGE_EDGES if edges is None else edges)
 
 
-def round_income(x):
+def round_income(x, edges=None):
     """
     Round income to the lower 10000th
     Intput:
-    - income
+    - income, as a scalar, array or series
+    - edges: bin edges (default: INCOME_EDGES)
     Output:
     - lower 10000th of the income. Return 0 if the income
     is less than 30,000 or more than 120,000
     """
-    for y in range(30, 130, 10):
-        if x >= y*1000 and x < (y+10)*1000:
-            return y*1000
-    return 0
+    return bin_values(x, INCOME_EDGES if edges is None else edges)
 
 def get_offer_stat(customers, stat, offer):
     """ Get any column for customers that received but not viewed an offer,
@@ -306,7 +537,7 @@ def get_average_expense(customers, offer):
 
     return rcv_avg, vwd_avg, cpd_avg
 
-def get_offer_stat_by(customers, stat, offer, by_col, aggr='sum'):
+def get_offer_stat_by(customers, stat, offer, by_col, aggr='sum', cube=None):
     """ Get any column for customers that received but not viewed an offer,
     viewed but not completed the offer, and those that viewed and completed
     the offer, grouped by a column
@@ -316,9 +547,19 @@ def get_offer_stat_by(customers, stat, offer, by_col, aggr='sum'):
     - offer: offer of interest
     - by_col: column used to group the data
     - aggr: aggregation method sum or mean
+    - cube: cohort cube of the customers. If given, the data is read from it
+    instead of grouping the customers again.
     Output:
     - (received, viewed, completed): tuple with sum aggregation
     """
+    if cube is not None:
+        cpd = None
+        if offer not in ['informational', 'I1', 'I2']:
+            cpd = get_cohort_stat(cube, stat, offer, 'completed', by_col, aggr)
+        return (get_cohort_stat(cube, stat, offer, 'received', by_col, aggr),
+                get_cohort_stat(cube, stat, offer, 'viewed', by_col, aggr),
+                cpd)
+
     valid = (customers.valid == 1)
     rcv_col = '{}_received'.format(offer)
     vwd_col = '{}_viewed'.format(offer)
@@ -344,7 +585,7 @@ def get_offer_stat_by(customers, stat, offer, by_col, aggr='sum'):
     return rcv, vwd, cpd
 
 
-def get_average_expense_by(customers, offer, by_col):
+def get_average_expense_by(customers, offer, by_col, cube=None):
     """ Get the average expense for customers that received but not
     viewed an offer, viewed but not completed the offer, and those
     that viewed and completed the offer, group by a column
@@ -352,15 +593,18 @@ def get_average_expense_by(customers, offer, by_col):
     - customers: dataframe with aggregated data of the offers
     - offer: offer of interest
     - by_col: column used to group the data
+    - cube: cohort cube of the customers (optional)
     Output:
     - (received, viewed, completed): tuple with the average expense
     """
     rcv_total, vwd_total, cpd_total = get_offer_stat_by(customers,
                                                         'total_expense',
-                                                        offer, by_col)
+                                                        offer, by_col,
+                                                        cube=cube)
     rcv_trans, vwd_trans, cpd_trans = get_offer_stat_by(customers,
                                                         'total_transactions',
-                                                        offer, by_col)
+                                                        offer, by_col,
+                                                        cube=cube)
 
     rcv_avg = rcv_total / rcv_trans
     rcv_avg.fillna(0, inplace=True)
@@ -372,3 +616,68 @@ def get_average_expense_by(customers, offer, by_col):
         cpd_avg = cpd_total / cpd_trans
 
     return rcv_avg, vwd_avg, cpd_avg
+
+
+def cohort_cube(customers, offers=None):
+    """ Aggregate total_expense, total_transactions and net_expense of the
+    valid customers by offer, funnel stage, age_group, income_group and
+    gender in one pass. The stages are the ones of get_offer_stat_by.
+    Input:
+    - customers: dataframe with aggregated data of the offers
+    - offers: offers and offer types to be included (default: all)
+    Output:
+    - cube: dict from (offer, stage, by_col) to a dataframe indexed by by_col,
+    with the sum, count and mean of each column. by_col is age_group,
+    income_group or gender, or None for the cells of the full cube.
+    """
+    offers = offers or OFFER_TYPES + OFFER_IDS
+    columns = SEGMENT_LEVELS + COHORT_STATS
+    valid = customers[customers.valid == 1]
+    parts = dict()
+    for offer in offers:
+        received = valid['{}_received'.format(offer)] > 0
+        viewed = valid['{}_viewed'.format(offer)] > 0
+        parts[(offer, 'received')] = valid.loc[received & ~viewed, columns]
+        if offer in ['informational', 'I1', 'I2']:
+            parts[(offer, 'viewed')] = valid.loc[viewed, columns]
+            continue
+        completed = valid['{}_completed'.format(offer)] > 0
+        parts[(offer, 'viewed')] = valid.loc[viewed & ~completed, columns]
+        parts[(offer, 'completed')] = valid.loc[completed, columns]
+
+    cohorts = pd.concat(parts.values(), keys=parts.keys(),
+                        names=['offer', 'stage'])
+    cohorts = cohorts.droplevel(2).set_index(SEGMENT_LEVELS, append=True)
+    cells = cohorts.groupby(level=['offer', 'stage'] + SEGMENT_LEVELS,
+                            observed=True).agg(['sum', 'count'])
+
+    # Roll the cells up to each level, so reading a slice is a lookup
+    cube = dict()
+    for by_col in [None] + SEGMENT_LEVELS:
+        levels = ['offer', 'stage'] + ([by_col] if by_col else SEGMENT_LEVELS)
+        rolled = cells.groupby(level=levels, observed=True).sum()
+        for stat in COHORT_STATS:
+            rolled[(stat, 'mean')] = (rolled[(stat, 'sum')] /
+                                      rolled[(stat, 'count')])
+        for (offer, stage), data in rolled.groupby(level=[0, 1]):
+            cube[(offer, stage, by_col)] = data.droplevel([0, 1])
+    return cube
+
+
+def get_cohort_stat(cube, stat, offer, stage, by_col, aggr='sum'):
+    """ Get the sum or mean of a column for the customers in a stage of an
+    offer, grouped by a column, from the cohort cube
+    Input:
+    - cube: cohort cube of the customers
+    - stat: total_expense, total_transactions or net_expense
+    - offer: offer of interest
+    - stage: received, viewed or completed
+    - by_col: age_group, income_group or gender
+    - aggr: aggregation method sum or mean
+    Output:
+    - series with the aggregated column per value of by_col
+    """
+    data = cube.get((offer, stage, by_col))
+    if data is None:
+        return pd.Series(dtype=float, name=stat)
+    return data[(stat, aggr)].rename(stat)
@@ -0,0 +1,120 @@
+import sys
+import json
+import time
+import functools
+import tracemalloc
+import pandas as pd
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, the rss fields are left out there
+    resource = None
+
+# Functions receiving the record of every instrumented call. The
+# instrumentation is disabled while the list is empty.
+sinks = []
+state = {'depth': 0, 'trace_memory': False}
+# Unit of ru_maxrss in bytes: KB on Linux, bytes on macOS
+RSS_UNIT = 1 if sys.platform == 'darwin' else 2**10
+
+
+def enable(sink=None, trace_memory=False):
+    """ Start recording the instrumented functions
+    Input:
+    - sink: function called with the record of every call (default:
+    print_sink). It can be called more than once to add sinks.
+    - trace_memory: also record the allocations with tracemalloc, which
+    slows down the calls
+    """
+    sinks.append(sink or print_sink)
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        state['trace_memory'] = True
+
+
+def disable():
+    """ Stop recording and remove all the sinks """
+    sinks.clear()
+    if state['trace_memory']:
+        tracemalloc.stop()
+        state['trace_memory'] = False
+
+
+def print_sink(record):
+    """ Write a record as a json line to stderr """
+    sys.stderr.write(json.dumps(record) + '\n')
+
+
+def json_lines_sink(path):
+    """ Get a sink that appends the records to a json-lines file
+    Input:
+    - path: json-lines file
+    Output:
+    - sink function
+    """
+    def sink(record):
+        with open(path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+    return sink
+
+
+def frame_stats(obj):
+    """ Get the rows and the memory in MB of a dataframe or a series. The
+    memory includes the python objects of object columns, e.g. the strings
+    of customer_id and offer_id, which takes a pass over them.
+    Input:
+    - obj: any object
+    Output:
+    - (rows, mb): tuple, with None for objects that are not frames
+    """
+    if isinstance(obj, pd.DataFrame):
+        return len(obj), obj.memory_usage(index=True, deep=True).sum() / 2**20
+    if isinstance(obj, pd.Series):
+        return len(obj), obj.memory_usage(index=True, deep=True) / 2**20
+    return None, None
+
+
+def instrument(func):
+    """ Decorator that records the wall time, cpu time, memory and row
+    counts of the calls of a function while the instrumentation is enabled.
+    When it is disabled the function is called directly.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not sinks:
+            return func(*args, **kwargs)
+
+        if resource:
+            rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            traced_before = tracemalloc.get_traced_memory()[0]
+            # Nested calls keep the peak of the outer one
+            if state['depth'] == 0:
+                tracemalloc.reset_peak()
+        state['depth'] += 1
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            state['depth'] -= 1
+        record = {'stage': func.__name__, 'module': func.__module__,
+                  'wall_s': time.perf_counter() - wall,
+                  'cpu_s': time.process_time() - cpu}
+        if resource:
+            rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            record['peak_rss_mb'] = rss_after * RSS_UNIT / 2**20
+            record['peak_rss_delta_mb'] = \
+                (rss_after - rss_before) * RSS_UNIT / 2**20
+        if tracing:
+            traced, peak = tracemalloc.get_traced_memory()
+            record['traced_delta_mb'] = (traced - traced_before) / 2**20
+            record['traced_peak_mb'] = (peak - traced_before) / 2**20
+        inputs = [frame_stats(a)[0] for a in args + tuple(kwargs.values())]
+        record['input_rows'] = [n for n in inputs if n is not None]
+        record['output_rows'], record['output_mb'] = frame_stats(result)
+        for sink in sinks:
+            sink(record)
+        return result
+    return wrapper
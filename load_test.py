@@ -0,0 +1,112 @@
+import time
+import json
+import asyncio
+import argparse
+import numpy as np
+
+
+async def request(reader, writer, method, path, payload=None):
+    """ Send an http request on an open connection and read the response
+    Input:
+    - reader: asyncio stream reader
+    - writer: asyncio stream writer
+    - method: http method
+    - path: request path
+    - payload: json compatible body (optional)
+    Returns:
+    - (status, payload): tuple with the http status and the decoded body
+    """
+    body = json.dumps(payload).encode() if payload is not None else b''
+    writer.write('{} {} HTTP/1.1\r\nHost: localhost\r\nContent-Type: '
+                 'application/json\r\nContent-Length: {}\r\n\r\n'.format(
+                     method, path, len(body)).encode() + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if not line.strip():
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+    return status, json.loads(await reader.readexactly(length))
+
+
+def random_customers(rng, n):
+    """ Draw customers with the ranges of the profile dataset
+    Input:
+    - rng: numpy random generator
+    - n: number of customers
+    Returns:
+    - list of request payloads
+    """
+    ages = rng.integers(18, 101, n)
+    incomes = rng.integers(30, 121, n) * 1000
+    genders = rng.choice(['M', 'F', 'O'], n)
+    return [{'age': int(a), 'income': int(i), 'gender': g}
+            for a, i, g in zip(ages, incomes, genders)]
+
+
+async def client(host, port, payloads, latencies):
+    """ Send requests one after the other on a single connection
+    Input:
+    - host: service address
+    - port: service port
+    - payloads: request payloads
+    - latencies: list where the latency of every request is appended
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    for payload in payloads:
+        start = time.perf_counter()
+        status, _ = await request(reader, writer, 'POST', '/recommend',
+                                  payload)
+        if status != 200:
+            raise RuntimeError('request failed with status {}'.format(status))
+        latencies.append(time.perf_counter() - start)
+    writer.close()
+
+
+async def load_test(host='127.0.0.1', port=8080, requests=10000,
+                    concurrency=64, seed=0):
+    """ Drive the recommendation service with concurrent clients
+    Input:
+    - host: service address
+    - port: service port
+    - requests: total number of requests
+    - concurrency: number of concurrent connections
+    - seed: random seed of the customers
+    Returns:
+    - dict with the client side throughput and latency percentiles, and
+    the metrics reported by the service
+    """
+    payloads = random_customers(np.random.default_rng(seed), requests)
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*[client(host, port, payloads[i::concurrency],
+                                  latencies) for i in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    latencies = np.array(latencies) * 1000
+    reader, writer = await asyncio.open_connection(host, port)
+    _, metrics = await request(reader, writer, 'GET', '/metrics')
+    writer.close()
+    return {'requests': requests, 'concurrency': concurrency,
+            'elapsed_s': elapsed, 'requests_per_s': requests / elapsed,
+            'latency_p50_ms': float(np.percentile(latencies, 50)),
+            'latency_p90_ms': float(np.percentile(latencies, 90)),
+            'latency_p99_ms': float(np.percentile(latencies, 99)),
+            'service': metrics}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Load test of the recommendation service')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--requests', type=int, default=10000)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    results = asyncio.run(load_test(args.host, args.port, args.requests,
+                                    args.concurrency, args.seed))
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,110 @@
+import math
+import numpy as np
+
+
+class QuantileSketch:
+    """ Mergeable quantile sketch with relative error guarantees, following
+    DDSketch (Masson et al., 2019). Positive values are counted in
+    logarithmic buckets, values <= 0 are counted as 0.
+
+    Error bound: for values >= 0, quantile(q) returns a value within a
+    relative error of relative_accuracy of the quantile of pandas. The two
+    ranks pandas interpolates between are each within that relative error,
+    and so is their weighted mean. The bound holds after any number of
+    merges, and the size only grows with the logarithm of the value range.
+    Input:
+    - relative_accuracy: relative error of the quantiles (default: 1%)
+    """
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = dict()
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, values):
+        """ Add values to the sketch
+        Input:
+        - values: scalar, array or series of values
+        """
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[~np.isnan(values)]
+        positive = values[values > 0]
+        self.zero_count += len(values) - len(positive)
+        self.count += len(values)
+        index = np.ceil(np.log(positive) / self.log_gamma).astype(int)
+        for i, n in zip(*np.unique(index, return_counts=True)):
+            self.buckets[int(i)] = self.buckets.get(int(i), 0) + int(n)
+        return self
+
+    def merge(self, other):
+        """ Add the values of another sketch with the same accuracy
+        Input:
+        - other: sketch to be merged into this one
+        """
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError('Sketches with different accuracy')
+        for i, n in other.buckets.items():
+            self.buckets[i] = self.buckets.get(i, 0) + n
+        self.zero_count += other.zero_count
+        self.count += other.count
+        return self
+
+    def value(self, rank):
+        """ Get the approximate value of a rank of the sorted values
+        Input:
+        - rank: rank from 0 to count - 1
+        Output:
+        - representative value of the bucket holding the rank
+        """
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for i in sorted(self.buckets):
+            seen += self.buckets[i]
+            if seen > rank:
+                return 2 * self.gamma ** i / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+    def quantile(self, q):
+        """ Get an approximate quantile of the values, with the same linear
+        interpolation between ranks as pandas quantile
+        Input:
+        - q: quantile, between 0 and 1
+        Output:
+        - approximate quantile, NaN if the sketch is empty
+        Raises:
+        - ValueError if q is not between 0 and 1
+        """
+        if not 0 <= q <= 1:
+            raise ValueError('quantile should be in the interval [0, 1], got '
+                             '{}'.format(q))
+        if self.count == 0:
+            return np.nan
+        # pandas goes through a percentile, q * 100, and back: the same
+        # float rounding gives the same ranks and weights
+        position = (self.count - 1) * (q * 100 / 100)
+        below = math.floor(position)
+        gamma = position - below
+        a = self.value(below)
+        b = self.value(min(below + 1, self.count - 1))
+        diff = b - a
+        if gamma >= 0.5:
+            return b - diff * (1 - gamma)
+        return a + diff * gamma
+
+    def to_dict(self):
+        """ Serialize the sketch to a json compatible dict """
+        return {'relative_accuracy': self.relative_accuracy,
+                'zero_count': self.zero_count,
+                'buckets': {str(i): n for i, n in self.buckets.items()}}
+
+    @classmethod
+    def from_dict(cls, data):
+        """ Build a sketch serialized with to_dict """
+        sketch = cls(data['relative_accuracy'])
+        sketch.buckets = {int(i): n for i, n in data['buckets'].items()}
+        sketch.zero_count = data['zero_count']
+        sketch.count = sketch.zero_count + sum(sketch.buckets.values())
+        return sketch
@@ -0,0 +1,292 @@
+import time
+import json
+import asyncio
+import argparse
+from collections import deque
+import numpy as np
+from eda import round_age, round_income
+from recommendations import OFFERS, build_segment_index, \
+    get_most_popular_offers_indexed
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+           405: 'Method Not Allowed', 500: 'Internal Server Error',
+           503: 'Service Unavailable'}
+
+
+def parse_request(body):
+    """ Decode and check the body of a POST /recommend request
+    Input:
+    - body: request body, a json object with the optional fields income,
+    age, gender, n_top and q
+    Returns:
+    - dict with the fields of the request
+    Raises:
+    - ValueError if the body is not a json object, has unknown fields, n_top
+    is not a positive integer or q is not a number between 0 and 1
+    """
+    request = json.loads(body or b'{}')
+    if not isinstance(request, dict):
+        raise ValueError('the body must be a json object')
+    fields = ['income', 'age', 'gender', 'n_top', 'q']
+    unknown = set(request) - set(fields)
+    if unknown:
+        raise ValueError('unknown fields {}'.format(sorted(unknown)))
+    # bool is a subclass of int, true and false are not accepted either
+    n_top = request.get('n_top', 2)
+    if isinstance(n_top, bool) or not isinstance(n_top, int) or n_top < 1:
+        raise ValueError('n_top must be a positive integer, got {!r}'.format(
+            n_top))
+    q = request.get('q', 0.5)
+    if isinstance(q, bool) or not isinstance(q, (int, float)) or \
+            not 0 <= q <= 1:
+        raise ValueError('q must be a number between 0 and 1, got {!r}'
+                         .format(q))
+    return request
+
+
+class RecommendationService:
+    """ Serve the offer rankings of get_most_popular_offers_filtered from a
+    segment index kept in memory. Requests waiting in the queue are
+    evaluated together: the batcher waits up to window_ms after the first
+    request, and every distinct segment and quantile of the batch is ranked
+    once.
+    Input:
+    - customers: dataframe with aggregated data of the offers
+    - window_ms: time the batcher waits for more requests
+    - max_batch: maximum number of requests evaluated at once
+    - loader: function returning a rebuilt customers dataframe, called
+    by POST /reload (optional)
+    - history: number of latencies kept for the percentiles
+    """
+    def __init__(self, customers, window_ms=2, max_batch=256, loader=None,
+                 history=10000):
+        self.index = build_segment_index(customers)
+        self.version = 0
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.loader = loader
+        self.queue = None
+        self.latencies = deque(maxlen=history)
+        self.batch_sizes = deque(maxlen=history)
+        self.requests = 0
+        self.errors = 0
+        self.max_queue_depth = 0
+
+    async def swap(self, customers):
+        """ Replace the customers dataframe. The new index is built in a
+        thread, the batches in flight finish with the previous one.
+        Input:
+        - customers: rebuilt customers dataframe
+        """
+        loop = asyncio.get_running_loop()
+        index = await loop.run_in_executor(None, build_segment_index,
+                                           customers)
+        self.index = index
+        self.version += 1
+
+    async def recommend(self, income=None, age=None, gender=None, n_top=2,
+                        q=0.5):
+        """ Queue a request and wait for its batch to be evaluated
+        Input:
+        - income: customer income
+        - age: customer age
+        - gender:  'M', 'F', or 'O'
+        - n_top: number of offers to be returned (default: 2)
+        - q: quantile used for sorting
+        Returns:
+        - dict with the sorted offers and the net_expense of every offer
+        """
+        start = time.perf_counter()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put(((income, age, gender, n_top, q), future))
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+        try:
+            return await future
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+
+    async def batcher(self):
+        """ Take the queued requests in batches and evaluate them """
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(),
+                                                        timeout))
+                except asyncio.TimeoutError:
+                    break
+            # Take whatever else is already waiting
+            while len(batch) < self.max_batch and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            self.batch_sizes.append(len(batch))
+            self.evaluate(batch)
+
+    def evaluate(self, batch):
+        """ Rank the offers once per distinct segment and quantile of a
+        batch and resolve the futures of its requests
+        Input:
+        - batch: list of (request, future) tuples
+        """
+        index = self.index
+        rankings = dict()
+        for (income, age, gender, n_top, q), future in batch:
+            if future.done():
+                continue
+            try:
+                income_gr = round_income(income) if income else 0
+                age_gr = round_age(age) if age else 0
+                key = (age_gr, income_gr, gender or None, q)
+                if key not in rankings:
+                    rankings[key] = get_most_popular_offers_indexed(
+                        index, len(OFFERS), q, income, age, gender)
+                offers, offers_dict = rankings[key]
+                result = {'offers': offers[:n_top],
+                          'net_expense': {o: None if np.isnan(v) else float(v)
+                                          for o, v in offers_dict.items()},
+                          'version': self.version}
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            future.set_result(result)
+
+    def metrics(self):
+        """ Get the latency percentiles in ms, the queue depth and the batch
+        sizes of the recent requests. requests counts every POST /recommend
+        and errors the ones answered with an error, the latencies are those
+        of the requests that reached the queue, failed or not.
+        Returns:
+        - dict of metrics
+        """
+        latencies = np.array(self.latencies) * 1000
+        percentiles = dict()
+        for p in [50, 90, 99]:
+            key = 'latency_p{}_ms'.format(p)
+            percentiles[key] = float(np.percentile(latencies, p)) \
+                if len(latencies) else None
+        sizes = np.array(self.batch_sizes)
+        return dict(percentiles, requests=self.requests, errors=self.errors,
+                    queue_depth=self.queue.qsize() if self.queue else 0,
+                    max_queue_depth=self.max_queue_depth,
+                    batches=len(sizes),
+                    mean_batch_size=float(sizes.mean()) if len(sizes)
+                    else None,
+                    max_batch_size=int(sizes.max()) if len(sizes) else None,
+                    version=self.version)
+
+    async def handle(self, method, path, body):
+        """ Route an http request
+        Input:
+        - method: http method
+        - path: request path
+        - body: request body
+        Returns:
+        - (status, payload): tuple with the http status and a json
+        compatible payload
+        """
+        if path == '/recommend':
+            if method != 'POST':
+                return 405, {'error': 'use POST'}
+            self.requests += 1
+            try:
+                return 200, await self.recommend(**parse_request(body))
+            except (TypeError, ValueError) as e:
+                self.errors += 1
+                return 400, {'error': str(e)}
+            except Exception:
+                self.errors += 1
+                raise
+        if path == '/metrics':
+            return 200, self.metrics()
+        if path == '/reload':
+            if method != 'POST':
+                return 405, {'error': 'use POST'}
+            if self.loader is None:
+                return 503, {'error': 'no loader configured'}
+            # The current index is kept if the rebuild fails
+            loop = asyncio.get_running_loop()
+            try:
+                customers = await loop.run_in_executor(None, self.loader)
+                await self.swap(customers)
+            except Exception as e:
+                return 503, {'error': 'reload failed: {!r}'.format(e),
+                             'version': self.version}
+            return 200, {'version': self.version}
+        return 404, {'error': 'unknown path {}'.format(path)}
+
+    async def connection(self, reader, writer):
+        """ Serve the http/1.1 requests of a connection, keeping it open
+        between requests
+        Input:
+        - reader: asyncio stream reader
+        - writer: asyncio stream writer
+        """
+        try:
+            while True:
+                line = await reader.readline()
+                if not line.strip():
+                    break
+                method, path = line.decode('latin-1').split()[:2]
+                headers = dict()
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0))
+                body = await reader.readexactly(length) if length else b''
+                try:
+                    status, payload = await self.handle(method, path, body)
+                except Exception as e:
+                    status, payload = 500, {'error': repr(e)}
+                data = json.dumps(payload).encode()
+                writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json'
+                             '\r\nContent-Length: {}\r\n\r\n'.format(
+                                 status, REASONS[status], len(data)).encode()
+                             + data)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8080):
+        """ Start the batcher and the http server and run until cancelled
+        Input:
+        - host: address to listen on
+        - port: port to listen on
+        """
+        self.queue = asyncio.Queue()
+        batcher = asyncio.create_task(self.batcher())
+        server = await asyncio.start_server(self.connection, host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+
+if __name__ == '__main__':
+    from data_cache import load_datasets
+
+    parser = argparse.ArgumentParser(
+        description='Serve the offer recommendations over http')
+    parser.add_argument('--data-dir', default='data')
+    parser.add_argument('--cache-dir', default='data/cache')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--window-ms', type=float, default=2)
+    parser.add_argument('--max-batch', type=int, default=256)
+    args = parser.parse_args()
+
+    loader = lambda: load_datasets(args.data_dir, args.cache_dir)[-1]
+    service = RecommendationService(loader(), args.window_ms, args.max_batch,
+                                    loader)
+    asyncio.run(service.serve(args.host, args.port))
@@ -1,10 +1,16 @@
 import math
+from collections import OrderedDict
+from itertools import product
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib
-from eda import *
+from instrumentation import instrument
+from eda import round_age, round_income
+from quantile_sketch import QuantileSketch
 
+OFFERS = ['I1', 'I2', 'B1', 'B2', 'B3', 'B4', 'D1', 'D2', 'D3', 'D4']
+SEGMENT_COLUMNS = ['age_group', 'income_group', 'gender']
+
+@instrument
 def get_most_popular_offers(customers, n_top=2, q=0.5, offers=None):
     """ Sort offers based on the ones that result in the highest net_expense
     Input:
@@ -16,13 +22,15 @@ def get_most_popular_offers(customers, n_top=2, q=0.5, offers=None):
     - sorted list of offers, in descending order according to the median net_expense
     """
     if not offers:
-        offers = ['I1', 'I2', 'B1', 'B2', 'B3',
-                  'B4', 'D1', 'D2', 'D3', 'D4']
-    offers.sort(key=lambda x: get_net_expense(customers, x, q), reverse=True)
-    offers_dict = {o: get_net_expense(customers, o, q) for o in offers}
+        offers = OFFERS
+    # Compute every quantile once and leave the list of the caller untouched
+    net_expense = {o: get_net_expense(customers, o, q) for o in offers}
+    offers = sorted(offers, key=net_expense.get, reverse=True)
+    offers_dict = {o: net_expense[o] for o in offers}
     return offers[:n_top], offers_dict
 
 
+@instrument
 def get_most_popular_offers_filtered(customers, n_top=2, q=0.5, income=None,
                                      age=None, gender=None):
     """ Sort offers based on the ones that result in the highest net_expense
@@ -36,6 +44,21 @@ def get_most_popular_offers_filtered(customers, n_top=2, q=0.5, income=None,
     - sorted list of offers, in descending order according to the
     median net_expense
     """
+    return get_most_popular_offers(filter_segment(customers, income, age,
+                                                  gender), n_top, q)
+
+
+def filter_segment(customers, income=None, age=None, gender=None):
+    """ Keep the valid customers in the income group, age group and gender
+    of a customer
+    Input:
+    - customers: dataframe with aggregated data of the offers
+    - income: customer income
+    - age: customer age
+    - gender:  'M', 'F', or 'O'
+    Returns:
+    - customers of the segment
+    """
     flag = (customers.valid == 1)
     if income:
         income_gr = round_income(income)
@@ -47,7 +70,7 @@ def get_most_popular_offers_filtered(customers, n_top=2, q=0.5, income=None,
             flag = flag & (customers.age_group == age_gr)
     if gender:
         flag = flag & (customers.gender == gender)
-    return get_most_popular_offers(customers[flag], n_top, q)
+    return customers[flag]
 
 def get_net_expense(customers, offer, q=0.5):
     """ Get the net_expense for customers that viewed and completed and offer
@@ -57,12 +80,428 @@ def get_net_expense(customers, offer, q=0.5):
     Returns:
     - net_expense median
     """
+    return customers[net_expense_flag(customers, offer)].net_expense.quantile(q)
+
+
+def net_expense_flag(customers, offer):
+    """ Get the customers that viewed and completed an offer, with a
+    positive net_expense and at least 5 transactions
+    Input:
+    - customers: dataframe with aggregated data of the offers
+    - offer: offer of interest
+    Returns:
+    - boolean series
+    """
     flag = (customers['{}_viewed'.format(offer)] > 0)
     flag = flag & (customers.net_expense > 0)
     flag = flag & (customers.total_transactions >= 5)
     if offer not in ['I1', 'I2']:
         flag = flag & (customers['{}_completed'.format(offer)] > 0)
-    return customers[flag].net_expense.quantile(q)
+    return flag
+
 
+def build_segment_index(customers):
+    """ Precompute, for every segment and offer, the sorted net_expense of
+    the customers considered by get_net_expense. Segments are all the
+    combinations of age_group, income_group and gender, where None stands
+    for any value.
+    Input:
+    - customers: dataframe with aggregated data of the offers
+    Returns:
+    - index: dict from (age_group, income_group, gender, offer) to a sorted
+    array of net_expense
+    """
+    index = dict()
+    valid = customers[customers.valid == 1]
+    for offer in OFFERS:
+        eligible = valid[net_expense_flag(valid, offer)]
+        eligible = eligible.sort_values('net_expense')
+        for used in product([False, True], repeat=len(SEGMENT_COLUMNS)):
+            by = [c for c, u in zip(SEGMENT_COLUMNS, used) if u]
+            if not by:
+                index[(None, None, None, offer)] = eligible.net_expense.values
+                continue
+            groups = eligible.groupby(by, observed=True).net_expense
+            for key, group in groups:
+                key = iter(key if isinstance(key, tuple) else (key,))
+                segment = tuple(next(key) if u else None for u in used)
+                index[segment + (offer,)] = group.values
+    return index
 
 
+def get_most_popular_offers_indexed(index, n_top=2, q=0.5, income=None,
+                                    age=None, gender=None):
+    """ Same as get_most_popular_offers_filtered, but reading the net_expense
+    of the segment from an index built with build_segment_index
+    Input:
+    - index: segment index of the customers
+    - n_top: number of offers to be returned (default: 2)
+    - q: quantile used for sorting
+    - income: customer income
+    - age: customer age
+    - gender:  'M', 'F', or 'O'
+    Returns:
+    - sorted list of offers, in descending order according to the
+    median net_expense
+    """
+    income_gr = round_income(income) if income else 0
+    age_gr = round_age(age) if age else 0
+    segment = (age_gr or None, income_gr or None, gender or None)
+    offers_dict = dict()
+    for offer in OFFERS:
+        offers_dict[offer] = sorted_quantile(index.get(segment + (offer,),
+                                                       []), q)
+    offers = sorted(offers_dict, key=offers_dict.get, reverse=True)
+    return offers[:n_top], {o: offers_dict[o] for o in offers}
+
+
+def sorted_quantile(values, q):
+    """ Quantile of sorted values, with the same linear interpolation as
+    pandas quantile, without sorting or partitioning the values again
+    Input:
+    - values: sorted array
+    - q: quantile, between 0 and 1
+    Returns:
+    - quantile of the values, NaN if there are none
+    Raises:
+    - ValueError if q is not between 0 and 1, like pandas quantile
+    """
+    if not 0 <= q <= 1:
+        raise ValueError('quantile should be in the interval [0, 1], got '
+                         '{}'.format(q))
+    if len(values) == 0:
+        return np.nan
+    # pandas goes through a percentile, q * 100, and back: the same float
+    # rounding gives bit-identical positions
+    position = (len(values) - 1) * (q * 100 / 100)
+    below = math.floor(position)
+    gamma = position - below
+    a = values[below]
+    b = values[min(below + 1, len(values) - 1)]
+    diff = b - a
+    if gamma >= 0.5:
+        return b - diff * (1 - gamma)
+    return a + diff * gamma
+
+
+class OfferRankingCache:
+    """ Bounded LRU cache of the offer rankings of a customers dataframe.
+    Rankings are keyed on the version of the dataframe, the segment of the
+    customer, the quantile and the offers to be sorted.
+    Input:
+    - customers: dataframe with aggregated data of the offers
+    - maxsize: maximum number of rankings kept
+    """
+    def __init__(self, customers, maxsize=1024):
+        self.customers = customers
+        self.maxsize = maxsize
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.rankings = OrderedDict()
+
+    def invalidate(self, customers=None):
+        """ Drop all the rankings, e.g. after the customers dataframe is
+        rebuilt
+        Input:
+        - customers: new customers dataframe (optional)
+        """
+        if customers is not None:
+            self.customers = customers
+        self.version += 1
+        self.rankings.clear()
+
+    def get_most_popular_offers(self, n_top=2, q=0.5, income=None, age=None,
+                                gender=None, offers=None):
+        """ Same as get_most_popular_offers_filtered, reusing the rankings
+        of previous calls for the same segment
+        Input:
+        - n_top: number of offers to be returned (default: 2)
+        - q: quantile used for sorting
+        - income: customer income
+        - age: customer age
+        - gender:  'M', 'F', or 'O'
+        - offers: list of offers to be sorted
+        Returns:
+        - sorted list of offers, in descending order according to the
+        median net_expense
+        """
+        offers = tuple(offers or OFFERS)
+        income_gr = round_income(income) if income else 0
+        age_gr = round_age(age) if age else 0
+        key = (self.version, age_gr, income_gr, gender or None, q, offers)
+        if key in self.rankings:
+            self.hits += 1
+            self.rankings.move_to_end(key)
+        else:
+            self.misses += 1
+            segment = filter_segment(self.customers, income, age, gender)
+            self.rankings[key] = get_most_popular_offers(segment, len(offers),
+                                                         q, list(offers))
+            while len(self.rankings) > self.maxsize:
+                self.rankings.popitem(last=False)
+        ranking, offers_dict = self.rankings[key]
+        return ranking[:n_top], dict(offers_dict)
+
+    def info(self):
+        """ Get the statistics of the cache
+        Returns:
+        - dict with hits, misses, current size and maximum size
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self.rankings), 'maxsize': self.maxsize}
+
+
+@instrument
+def get_most_popular_offers_batch(customers, profile, n_top=2, q=0.5):
+    """ Get the top offers of every customer of a profile table at once.
+    The rows are grouped by segment, the offers are sorted once per segment
+    and the result is broadcast back to the rows.
+    Input:
+    - customers: dataframe with aggregated data of the offers
+    - profile: dataframe with income, age and gender columns
+    - n_top: number of offers to be returned (default: 2)
+    - q: quantile used for sorting
+    Returns:
+    - dataframe with the same index as profile and the columns offer_1 to
+    offer_<n_top>, in descending order according to the median net_expense
+    """
+    index = build_segment_index(customers)
+    segments = pd.DataFrame({
+        'age_group': round_age(profile.age.values),
+        'income_group': round_income(profile.income.values),
+        'gender': profile.gender.where(profile.gender.notnull(), '').values})
+    unique = segments.drop_duplicates()
+    columns = ['offer_{}'.format(i + 1) for i in range(n_top)]
+    top = [get_most_popular_offers_indexed(index, n_top, q, income, age,
+                                           gender)[0]
+           for age, income, gender in unique.itertuples(index=False)]
+    top = pd.DataFrame(top, columns=columns, index=unique.index)
+    offers = pd.merge(segments, pd.concat([unique, top], axis=1), how='left',
+                      on=SEGMENT_COLUMNS)
+    offers.index = profile.index
+    return offers[columns]
+
+
+def build_offer_sketches(customers, relative_accuracy=0.01, sketches=None):
+    """ Add the net_expense considered by get_net_expense to one quantile
+    sketch per offer and segment (age_group, income_group, gender). It can
+    be called again with new customers to update the sketches.
+    Input:
+    - customers: dataframe with aggregated data of the offers
+    - relative_accuracy: relative error of the sketches
+    - sketches: sketches to be updated (optional)
+    Returns:
+    - sketches: dict from (age_group, income_group, gender, offer) to a
+    QuantileSketch
+    """
+    sketches = dict() if sketches is None else sketches
+    valid = customers[customers.valid == 1]
+    for offer in OFFERS:
+        eligible = valid[net_expense_flag(valid, offer)]
+        groups = eligible.groupby(SEGMENT_COLUMNS, observed=True).net_expense
+        for segment, values in groups:
+            key = segment + (offer,)
+            if key not in sketches:
+                sketches[key] = QuantileSketch(relative_accuracy)
+            sketches[key].add(values.values)
+    return sketches
+
+
+def get_most_popular_offers_sketch(sketches, n_top=2, q=0.5, income=None,
+                                   age=None, gender=None):
+    """ Same as get_most_popular_offers_filtered, but ranking the offers on
+    approximate quantiles. The sketches of the segments of the customer are
+    merged per offer.
+    Input:
+    - sketches: sketches built with build_offer_sketches
+    - n_top: number of offers to be returned (default: 2)
+    - q: quantile used for sorting
+    - income: customer income
+    - age: customer age
+    - gender:  'M', 'F', or 'O'
+    Returns:
+    - sorted list of offers, in descending order according to the
+    approximate median net_expense
+    """
+    income_gr = round_income(income) if income else 0
+    age_gr = round_age(age) if age else 0
+    segment = (age_gr or None, income_gr or None, gender or None)
+    merged = dict()
+    for key, sketch in sketches.items():
+        if all(s is None or s == k for s, k in zip(segment, key)):
+            if key[3] not in merged:
+                merged[key[3]] = QuantileSketch(sketch.relative_accuracy)
+            merged[key[3]].merge(sketch)
+    offers_dict = {o: merged[o].quantile(q) if o in merged else np.nan
+                   for o in OFFERS}
+    offers = sorted(offers_dict, key=offers_dict.get, reverse=True)
+    return offers[:n_top], {o: offers_dict[o] for o in offers}
+
+
+def bootstrap_quantiles(arrays, q=0.5, n_resamples=1000, seed=0):
+    """ Bootstrap the quantile of several sorted arrays at once. A resample
+    of an array of size n draws n indices floor(n * u) from uniform u, so
+    its order statistic of rank k is the value at floor(n * u_(k)), where
+    u_(k) ~ Beta(k + 1, n - k) is the order statistic of the uniforms, and
+    the next one is u_(k+1) = u_(k) + (1 - u_(k)) * Beta(1, n - k - 1).
+    Only the two order statistics interpolated by the quantile are drawn,
+    for all the arrays and resamples in one matrix, instead of the n values
+    of every resample.
+    Input:
+    - arrays: list of sorted arrays
+    - q: quantile, between 0 and 1
+    - n_resamples: number of bootstrap resamples
+    - seed: random seed
+    Returns:
+    - matrix of shape (n_resamples, len(arrays)) with the quantile of every
+    array in every resample, NaN for empty arrays
+    Raises:
+    - ValueError if q is not between 0 and 1
+    """
+    if not 0 <= q <= 1:
+        raise ValueError('quantile should be in the interval [0, 1], got '
+                         '{}'.format(q))
+    rng = np.random.default_rng(seed)
+    sizes = np.array([len(a) for a in arrays], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(np.int64)
+    values = np.concatenate([np.asarray(a, dtype=float) for a in arrays] +
+                            [np.empty(0)])
+    samples = np.full((n_resamples, len(arrays)), np.nan)
+    nonempty = sizes > 0
+    if not nonempty.any():
+        return samples
+    n = sizes[nonempty]
+    # Same linear interpolation as pandas quantile and sorted_quantile,
+    # including the float rounding of the percentile q * 100
+    position = (n - 1) * (q * 100 / 100)
+    below = np.floor(position).astype(np.int64)
+    gamma = position - below
+    shape = (n_resamples, len(n))
+    u_below = rng.beta(below + 1, n - below, shape)
+    # The gap to the next order statistic, Beta(1, m) = 1 - v ** (1 / m)
+    rest = np.maximum(n - below - 1, 1)
+    gap = 1 - rng.random(shape) ** (1 / rest)
+    u_above = np.where(n - below > 1, u_below + (1 - u_below) * gap, u_below)
+    start = offsets[nonempty]
+    lower = start + np.minimum((u_below * n).astype(np.int64), n - 1)
+    upper = start + np.minimum((u_above * n).astype(np.int64), n - 1)
+    a = values[lower]
+    b = values[upper]
+    diff = b - a
+    samples[:, nonempty] = np.where(gamma >= 0.5, b - diff * (1 - gamma),
+                                    a + diff * gamma)
+    return samples
+
+
+def rank_offers(values):
+    """ Rank offers in descending order of their values, NaN values last
+    Input:
+    - values: array with the offers in the last axis
+    Returns:
+    - array of the same shape with the rank of every offer, 0 is the best
+    """
+    values = np.where(np.isnan(values), -np.inf, values)
+    order = np.argsort(-values, axis=-1, kind='stable')
+    return np.argsort(order, axis=-1, kind='stable')
+
+
+def bootstrap_ranking(arrays, n_top=2, q=0.5, n_resamples=1000, alpha=0.05,
+                      seed=0):
+    """ Bootstrap confidence intervals and rank stability of the offer
+    rankings of one or more segments. The net_expense of every offer is
+    resampled on its own, with its number of customers held fixed.
+    The bootstrap distribution of the quantile of each offer is exact,
+    but the offers of a segment share customers and the resamples treat
+    them as independent. ci_low and ci_high are not affected. The joint
+    values, rank_stability and top_share, ignore the correlation between
+    offers, so for offers taken by the same customers they tend to
+    understate the stability of their order.
+    Input:
+    - arrays: list with one list of sorted net_expense arrays per segment,
+    in the order of OFFERS
+    - n_top: number of offers recommended
+    - q: quantile used for sorting
+    - n_resamples: number of bootstrap resamples
+    - alpha: the confidence intervals cover 1 - alpha
+    - seed: random seed
+    Returns:
+    - dict of arrays of shape (segments, offers): net_expense, rank,
+    ci_low, ci_high, rank_stability (share of resamples in which the offer
+    keeps its rank) and top_share (share of resamples in which the offer
+    is in the top n_top)
+    """
+    n_offers = len(OFFERS)
+    flat = [values for segment in arrays for values in segment]
+    point = np.array([sorted_quantile(values, q) for values in flat])
+    point = point.reshape(-1, n_offers)
+    samples = bootstrap_quantiles(flat, q, n_resamples, seed)
+    samples = samples.reshape(n_resamples, -1, n_offers)
+    rank = rank_offers(point)
+    ranks = rank_offers(samples)
+    # The samples of an offer are all NaN or none is, so the intervals are
+    # NaN only for offers without customers in the segment
+    ci_low, ci_high = np.quantile(samples, [alpha / 2, 1 - alpha / 2],
+                                  axis=0)
+    return {'net_expense': point, 'rank': rank, 'ci_low': ci_low,
+            'ci_high': ci_high,
+            'rank_stability': (ranks == rank).mean(axis=0),
+            'top_share': (ranks < n_top).mean(axis=0)}
+
+
+def get_most_popular_offers_bootstrap(customers, n_top=2, q=0.5, income=None,
+                                      age=None, gender=None,
+                                      n_resamples=1000, alpha=0.05, seed=0):
+    """ Same as get_most_popular_offers_filtered, together with bootstrap
+    confidence intervals of the net_expense quantile and the stability of
+    the rank of every offer
+    Input:
+    - customers: dataframe with aggregated data of the offers
+    - n_top: number of offers to be returned (default: 2)
+    - q: quantile used for sorting
+    - income: customer income
+    - age: customer age
+    - gender:  'M', 'F', or 'O'
+    - n_resamples: number of bootstrap resamples
+    - alpha: the confidence intervals cover 1 - alpha
+    - seed: random seed
+    Returns:
+    - sorted list of offers, in descending order according to the
+    median net_expense
+    - dataframe indexed by offer, in the same order, with the columns of
+    bootstrap_ranking, which also states the assumption of independent
+    offers behind rank_stability and top_share
+    """
+    segment = filter_segment(customers, income, age, gender)
+    arrays = [np.sort(segment[net_expense_flag(segment, o)].net_expense.values)
+              for o in OFFERS]
+    stats = bootstrap_ranking([arrays], n_top, q, n_resamples, alpha, seed)
+    stats = pd.DataFrame({k: v[0] for k, v in stats.items()}, index=OFFERS)
+    stats = stats.sort_values('rank')
+    return list(stats.index[:n_top]), stats
+
+
+def bootstrap_segment_index(index, n_top=2, q=0.5, n_resamples=1000,
+                            alpha=0.05, seed=0):
+    """ Bootstrap the offer rankings of every segment of an index built
+    with build_segment_index in one batch
+    Input:
+    - index: segment index of the customers
+    - n_top: number of offers recommended
+    - q: quantile used for sorting
+    - n_resamples: number of bootstrap resamples
+    - alpha: the confidence intervals cover 1 - alpha
+    - seed: random seed
+    Returns:
+    - dataframe indexed by age_group, income_group, gender and offer, with
+    the columns of bootstrap_ranking, which also states the assumption of
+    independent offers behind rank_stability and top_share
+    """
+    segments = sorted({key[:-1] for key in index},
+                      key=lambda s: tuple((v is None, str(v)) for v in s))
+    arrays = [[index.get(s + (o,), []) for o in OFFERS] for s in segments]
+    stats = bootstrap_ranking(arrays, n_top, q, n_resamples, alpha, seed)
+    keys = pd.MultiIndex.from_tuples([s + (o,) for s in segments
+                                      for o in OFFERS],
+                                     names=SEGMENT_COLUMNS + ['offer'])
+    return pd.DataFrame({k: v.ravel() for k, v in stats.items()}, index=keys)
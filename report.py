@@ -0,0 +1,102 @@
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import matplotlib
+# Render without a display, also in the worker processes
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from eda import *
+from data_cache import load_datasets
+
+# Data shared by the plots of every offer, set once per worker process
+shared = dict()
+
+
+def init_worker(customers, cube):
+    """ Keep the customers data and its cohort cube in the worker process
+    Input:
+    - customers: dataframe with aggregated data of the offers
+    - cube: cohort cube of the customers
+    """
+    shared['customers'] = customers
+    shared['cube'] = cube
+
+
+def render_offer(offer, output, fmt='png'):
+    """ Save the figures of plot_offer_expense and plot_offer_expense_by for
+    an offer and close them
+    Input:
+    - offer: offer or offer type
+    - output: output folder
+    - fmt: image format, png or svg
+    Output:
+    - list of the file names written
+    """
+    files = []
+    plots = [('expense', lambda: plot_offer_expense(shared['customers'],
+                                                    offer)),
+             ('expense_by', lambda: plot_offer_expense_by(shared['customers'],
+                                                          offer,
+                                                          shared['cube']))]
+    for name, plot in plots:
+        plot()
+        fig = plt.gcf()
+        filename = '{}_{}.{}'.format(offer, name, fmt)
+        fig.savefig(os.path.join(output, filename), bbox_inches='tight')
+        plt.close(fig)
+        files.append(filename)
+    return files
+
+
+def write_index(output, figures):
+    """ Write an html page with all the figures
+    Input:
+    - output: output folder
+    - figures: dict from offer to the list of its figure files
+    """
+    lines = ['<html><head><title>Offer report</title></head><body>']
+    for offer, files in figures.items():
+        lines.append('<h2>{}</h2>'.format(offer))
+        lines += ['<img src="{}" width="100%">'.format(f) for f in files]
+    lines.append('</body></html>')
+    with open(os.path.join(output, 'index.html'), 'w') as f:
+        f.write('\n'.join(lines))
+
+
+def build_report(customers, output, offers=None, workers=None, fmt='png'):
+    """ Render the figures of every offer in parallel processes and write
+    them with an index page to the output folder
+    Input:
+    - customers: dataframe with aggregated data of the offers
+    - output: output folder
+    - offers: offers and offer types to be plotted (default: all)
+    - workers: number of processes (default: number of cpus)
+    - fmt: image format, png or svg
+    Output:
+    - figures: dict from offer to the list of its figure files
+    """
+    offers = offers or OFFER_TYPES + OFFER_IDS
+    os.makedirs(output, exist_ok=True)
+    cube = cohort_cube(customers, offers)
+    with ProcessPoolExecutor(workers, initializer=init_worker,
+                             initargs=(customers, cube)) as pool:
+        files = pool.map(render_offer, offers, [output] * len(offers),
+                         [fmt] * len(offers))
+        figures = dict(zip(offers, files))
+    write_index(output, figures)
+    return figures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Render the offer figures of the eda into a folder')
+    parser.add_argument('--data-dir', default='data')
+    parser.add_argument('--cache-dir', default='data/cache')
+    parser.add_argument('--output', default='output/report')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--format', choices=['png', 'svg'], default='png')
+    args = parser.parse_args()
+
+    customers = load_datasets(args.data_dir, args.cache_dir)[-1]
+    build_report(customers, args.output, workers=args.workers,
+                 fmt=args.format)
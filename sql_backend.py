@@ -0,0 +1,96 @@
+import os
+import sqlite3
+import numpy as np
+import pandas as pd
+from data_preprocessing import stream_transcript, OFFER_NAMES
+from eda import EVENTS, OFFER_TYPES, OFFER_IDS, order_customers, \
+    add_demographics
+from instrumentation import instrument
+
+
+def build_database(db_path, portfolio_clean, transcript_path,
+                   chunksize=100000):
+    """ Load the portfolio and the transcript into an sqlite database file.
+    The transcript is parsed and inserted chunk by chunk, so it never has to
+    fit in memory.
+    Input:
+    - db_path: database file, it is replaced if it exists
+    - portfolio_clean: cleaned portfolio dataset
+    - transcript_path: path of the transcript json-lines file
+    - chunksize: number of transcript lines inserted at once
+    Returns:
+    - db_path
+    """
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    portfolio = portfolio_clean[['offer_id', 'offer_type', 'reward']].copy()
+    portfolio['name'] = portfolio.offer_id.map(OFFER_NAMES)
+    event_cols = ['event_offer_{}'.format(e) for e in EVENTS]
+    with sqlite3.connect(db_path) as con:
+        portfolio.to_sql('portfolio', con, index=False)
+        for chunk in stream_transcript(transcript_path, chunksize):
+            # Store the event as a single column: the offer stage or
+            # transaction
+            stage = np.array(EVENTS)[chunk[event_cols].values.argmax(axis=1)]
+            chunk['event'] = np.where(chunk.event_transaction == 1,
+                                      'transaction', stage)
+            chunk[['customer_id', 'time', 'event', 'offer_id', 'amount']]\
+                .to_sql('transcript', con, index=False, if_exists='append')
+        con.execute('CREATE INDEX transcript_customer '
+                    'ON transcript (customer_id)')
+    con.close()
+    return db_path
+
+
+def customers_query():
+    """ Build the query with the aggregated columns of per_customer_data.
+    Every column is NULL where a customer has no events, like in
+    aggregate_customers.
+    Returns:
+    - sql query
+    """
+    count = 'SUM(CASE WHEN {} THEN 1 END) AS "{}"'
+    reward = 'SUM(CASE WHEN {} THEN p.reward END) AS "{}"'
+    columns = ['SUM(CASE WHEN t.event = \'transaction\' THEN t.amount END) '
+               'AS total_expense',
+               count.format("t.event = 'transaction' "
+                            "AND t.amount IS NOT NULL", 'total_transactions')]
+    prefixes = [(None, '1')]
+    prefixes += [(ot, "p.offer_type = '{}'".format(ot)) for ot in OFFER_TYPES]
+    prefixes += [(oi, "p.name = '{}'".format(oi)) for oi in OFFER_IDS]
+    for prefix, condition in prefixes:
+        # Informational offers don't have completed or reward data
+        no_completed = prefix in ['informational', 'I1', 'I2']
+        for e in EVENTS:
+            if no_completed and e == 'completed':
+                continue
+            key = '{}_{}'.format(prefix, e) if prefix else e
+            columns.append(count.format(
+                "{} AND t.event = '{}'".format(condition, e), key))
+        if not no_completed:
+            key = '{}_reward'.format(prefix) if prefix else 'reward'
+            columns.append(reward.format(
+                "{} AND t.event = 'completed'".format(condition), key))
+    return ('SELECT t.customer_id,\n    {}\n'
+            'FROM transcript t LEFT JOIN portfolio p '
+            'ON t.offer_id = p.offer_id\n'
+            'GROUP BY t.customer_id\n'
+            'ORDER BY t.customer_id'.format(',\n    '.join(columns)))
+
+
+@instrument
+def per_customer_data_sql(db_path, profile):
+    """ Build the same dataframe as per_customer_data_fast, running the join
+    with the portfolio and the aggregation in the database built with
+    build_database. Only the aggregated rows are read into memory.
+    Input:
+    - db_path: database file
+    - profile: cleaned profile dataset
+    Output:
+    - customer: dataframe with aggregated data
+    """
+    with sqlite3.connect(db_path) as con:
+        customers = pd.read_sql(customers_query(), con,
+                                index_col='customer_id')
+    con.close()
+    return add_demographics(order_customers(customers), profile)
@@ -0,0 +1,184 @@
+import os
+import json
+import argparse
+import numpy as np
+
+# Offers of the original portfolio, merge_datasets relies on their ids
+PORTFOLIO = [
+    {'reward': 10, 'channels': ['email', 'mobile', 'social'], 'difficulty': 10,
+     'duration': 7.0, 'offer_type': 'bogo',
+     'id': 'ae264e3637204a6fb9bb56bc8210ddfd'},
+    {'reward': 10, 'channels': ['web', 'email', 'mobile', 'social'],
+     'difficulty': 10, 'duration': 5.0, 'offer_type': 'bogo',
+     'id': '4d5c57ea9a6940dd891ad53e9dbe8da0'},
+    {'reward': 0, 'channels': ['web', 'email', 'mobile'], 'difficulty': 0,
+     'duration': 4.0, 'offer_type': 'informational',
+     'id': '3f207df678b143eea3cee63160fa8bed'},
+    {'reward': 5, 'channels': ['web', 'email', 'mobile'], 'difficulty': 5,
+     'duration': 7.0, 'offer_type': 'bogo',
+     'id': '9b98b8c7a33c4b65b9aebfe6a799e6d9'},
+    {'reward': 5, 'channels': ['web', 'email'], 'difficulty': 20,
+     'duration': 10.0, 'offer_type': 'discount',
+     'id': '0b1e1539f2cc45b7b9fa7c272da2e1d7'},
+    {'reward': 3, 'channels': ['web', 'email', 'mobile', 'social'],
+     'difficulty': 7, 'duration': 7.0, 'offer_type': 'discount',
+     'id': '2298d6c36e964ae4a3e7e9706d1fb8c2'},
+    {'reward': 2, 'channels': ['web', 'email', 'mobile', 'social'],
+     'difficulty': 10, 'duration': 10.0, 'offer_type': 'discount',
+     'id': 'fafdcd668e3743c1bb461111dcafc2a4'},
+    {'reward': 0, 'channels': ['email', 'mobile', 'social'], 'difficulty': 0,
+     'duration': 3.0, 'offer_type': 'informational',
+     'id': '5a8bc65990b245e5a138643cd4eb9837'},
+    {'reward': 5, 'channels': ['web', 'email', 'mobile', 'social'],
+     'difficulty': 5, 'duration': 5.0, 'offer_type': 'bogo',
+     'id': 'f19421c1d4aa40978ebb69ca19b0e20d'},
+    {'reward': 2, 'channels': ['web', 'email', 'mobile'], 'difficulty': 10,
+     'duration': 7.0, 'offer_type': 'discount',
+     'id': '2906b810c7d4411798c6938adc9daaa5'}]
+
+# Size of the original profile dataset, times at which offers are sent out
+# and end of the experiment, in hours
+CUSTOMERS = 17000
+OFFER_TIMES = [0, 168, 336, 408, 504, 576]
+END_TIME = 714
+EVENTS = ['offer received', 'offer viewed', 'offer completed', 'transaction']
+
+
+def generate_profile(rng, n):
+    """ Generate customers with the distributions of the original data:
+    about 13% without demographic data (age 118, no gender nor income)
+    Input:
+    - rng: numpy random generator
+    - n: number of customers
+    Returns:
+    - dict of arrays with id, gender, age, income and became_member_on
+    """
+    ids = np.array([rng.bytes(16).hex() for _ in range(n)])
+    missing = rng.random(n) < 0.128
+    gender = rng.choice(['M', 'F', 'O'], n, p=[0.572, 0.414, 0.014])
+    age = np.clip(rng.normal(54.4, 17.4, n), 18, 101).astype(int)
+    income = np.clip(rng.normal(65000, 21600, n), 30000, 120000)
+    income = (income // 1000 * 1000).astype(int)
+    days = rng.integers(0, 1824, n)
+    member = (np.datetime64('2013-07-29') + days).astype(str)
+    age[missing] = 118
+    return {'id': ids, 'gender': np.where(missing, None, gender),
+            'age': age, 'income': np.where(missing, None, income),
+            'became_member_on': np.char.replace(member, '-', ''),
+            'missing': missing}
+
+
+def generate_transcript(rng, profile):
+    """ Generate the offer funnel (received, viewed, completed) of every
+    customer at each offer time, and their transactions
+    Input:
+    - rng: numpy random generator
+    - profile: output of generate_profile
+    Returns:
+    - dict of arrays with customer, event, offer, amount and time, sorted
+    by time
+    """
+    n = len(profile['id'])
+    duration = np.array([o['duration'] for o in PORTFOLIO]) * 24
+    difficulty = np.array([o['difficulty'] for o in PORTFOLIO])
+    informational = np.array([o['offer_type'] == 'informational'
+                              for o in PORTFOLIO])
+
+    # Offers received, viewed within their duration and completed
+    customer = np.repeat(np.arange(n), len(OFFER_TIMES))
+    sent = np.tile(OFFER_TIMES, n)
+    keep = rng.random(len(customer)) < 0.85
+    customer, sent = customer[keep], sent[keep]
+    offer = rng.integers(0, len(PORTFOLIO), len(customer))
+    view_time = sent + rng.exponential(24, len(customer)).astype(int)
+    viewed = (rng.random(len(customer)) < 0.75) & \
+        (view_time <= np.minimum(sent + duration[offer], END_TIME))
+    done_time = sent + (rng.random(len(customer)) *
+                        duration[offer]).astype(int)
+    completed = ~informational[offer] & (done_time <= END_TIME) & \
+        (rng.random(len(customer)) < np.where(viewed, 0.55, 0.25))
+
+    # Regular transactions, fewer for customers without demographic data
+    rate = rng.gamma(2, 4, n) * np.where(profile['missing'], 0.5, 1)
+    count = rng.poisson(rate)
+    tr_customer = np.repeat(np.arange(n), count)
+    tr_time = rng.integers(0, END_TIME + 1, len(tr_customer))
+    tr_amount = np.round(rng.lognormal(2.3, 0.7, len(tr_customer)), 2)
+    # Completing an offer comes with a transaction of at least the difficulty
+    done_amount = np.round(difficulty[offer[completed]] +
+                           rng.gamma(2, 3, completed.sum()), 2)
+
+    parts = [(customer, 0, offer, np.nan, sent),
+             (customer[viewed], 1, offer[viewed], np.nan, view_time[viewed]),
+             (customer[completed], 2, offer[completed], np.nan,
+              done_time[completed]),
+             (customer[completed], 3, -1, done_amount, done_time[completed]),
+             (tr_customer, 3, -1, tr_amount, tr_time)]
+    columns = [np.concatenate([np.broadcast_to(p[i], len(p[0]))
+                               for p in parts]) for i in range(5)]
+    order = np.argsort(columns[4], kind='stable')
+    return dict(zip(['customer', 'event', 'offer', 'amount', 'time'],
+                    [c[order] for c in columns]))
+
+
+def write_profile(path, profile):
+    """ Write the profile dataset as json lines """
+    with open(path, 'w') as f:
+        for gender, age, cid, member, income in zip(
+                profile['gender'], profile['age'], profile['id'],
+                profile['became_member_on'], profile['income']):
+            f.write(json.dumps({'gender': gender, 'age': int(age), 'id': cid,
+                                'became_member_on': member,
+                                'income': income if income is None
+                                else int(income)}) + '\n')
+
+
+def write_transcript(path, transcript, customer_ids):
+    """ Write the transcript dataset as json lines """
+    with open(path, 'w') as f:
+        for c, e, o, a, t in zip(transcript['customer'], transcript['event'],
+                                 transcript['offer'], transcript['amount'],
+                                 transcript['time']):
+            if e == 3:
+                value = '{{"amount": {!r}}}'.format(float(a))
+            elif e == 2:
+                value = '{{"offer_id": "{}", "reward": {}}}'.format(
+                    PORTFOLIO[o]['id'], PORTFOLIO[o]['reward'])
+            else:
+                value = '{{"offer id": "{}"}}'.format(PORTFOLIO[o]['id'])
+            f.write('{{"person": "{}", "event": "{}", "value": {}, '
+                    '"time": {}}}\n'.format(customer_ids[c], EVENTS[e],
+                                            value, t))
+
+
+def generate_datasets(output_dir, scale=1, seed=0):
+    """ Generate portfolio.json, profile.json and transcript.json with the
+    size of the original data times a scale factor
+    Input:
+    - output_dir: folder where the files are written
+    - scale: scale factor of the number of customers
+    - seed: random seed
+    Returns:
+    - dict from dataset name to its path
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    paths = {name: os.path.join(output_dir, '{}.json'.format(name))
+             for name in ['portfolio', 'profile', 'transcript']}
+    with open(paths['portfolio'], 'w') as f:
+        f.writelines(json.dumps(o) + '\n' for o in PORTFOLIO)
+    profile = generate_profile(rng, int(CUSTOMERS * scale))
+    write_profile(paths['profile'], profile)
+    write_transcript(paths['transcript'], generate_transcript(rng, profile),
+                     profile['id'])
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Generate synthetic Starbucks datasets')
+    parser.add_argument('--output', default='data/synthetic')
+    parser.add_argument('--scale', type=float, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    generate_datasets(args.output, args.scale, args.seed)
@@ -0,0 +1,347 @@
+import tempfile
+import numpy as np
+import pandas as pd
+from data_preprocessing import *
+from data_loaders import load_portfolio, load_profile
+from synthetic_data import generate_datasets
+
+# Small synthetic datasets shared by the checks
+data = dict()
+
+
+def synthetic_data(scale=0.05):
+    """ Generate and clean small synthetic datasets once
+    Returns:
+    - dict with the data folder, portfolio, profile and merged df
+    """
+    if not data:
+        data['dir'] = tempfile.mkdtemp()
+        paths = generate_datasets(data['dir'], scale, seed=1)
+        data['portfolio'] = load_portfolio(paths['portfolio'])
+        data['profile'] = load_profile(paths['profile'])
+        data['transcript_path'] = paths['transcript']
+        data['df'] = merge_datasets(data['portfolio'], data['profile'],
+                                    load_transcript(paths['transcript']))
+    return data
+
+
+def events(rows):
+    """ Build a merged dataframe from (customer, event, offer, time,
+    duration) tuples """
+    df = pd.DataFrame(rows, columns=['customer_id', 'event', 'offer_id',
+                                     'time', 'duration'])
+    for e in ['received', 'viewed', 'completed']:
+        df['event_offer_' + e] = (df.event == e).astype(np.uint8)
+    df['event_transaction'] = (df.event == 'transaction').astype(np.uint8)
+    return df.drop(columns='event')
+
+
+def test_attribution_overlapping_windows():
+    # A runs 10 days from t=0, B runs 1 day from t=5: after B expires the
+    # transactions go back to A until it expires too
+    df = events([('c', 'received', 'A', 0, 10),
+                 ('c', 'viewed', 'A', 1, 10),
+                 ('c', 'transaction', None, 3, None),
+                 ('c', 'received', 'B', 5, 1),
+                 ('c', 'viewed', 'B', 6, 1),
+                 ('c', 'transaction', None, 10, None),
+                 ('c', 'transaction', None, 50, None),
+                 ('c', 'transaction', None, 300, None),
+                 ('d', 'received', 'A', 0, 10),
+                 ('d', 'transaction', None, 2, None),
+                 ('e', 'transaction', None, 2, None)])
+    attributed = attribute_transactions(df)
+    transactions = attributed[attributed.event_transaction == 1]
+    assert transactions.attributed_offer_id.tolist() == \
+        ['A', 'B', 'A', None, None, None]
+
+
+def test_attribution_brute_force():
+    df = synthetic_data()['df']
+    attributed = attribute_transactions(df).attributed_offer_id
+    received = df[df.event_offer_received == 1]
+    viewed = df[df.event_offer_viewed == 1]
+    # Open windows of every customer: views after the latest reception of
+    # the same offer, until that reception expires
+    windows = dict()
+    for v in viewed.itertuples():
+        r = received[(received.customer_id == v.customer_id) &
+                     (received.offer_id == v.offer_id) &
+                     (received.time <= v.time)]
+        if len(r) == 0:
+            continue
+        expires = r.time.iloc[-1] + r.duration.iloc[-1] * 24
+        if v.time <= expires:
+            windows.setdefault(v.customer_id, []).append(
+                (v.time, expires, v.offer_id))
+    for t in df[df.event_transaction == 1].sample(300, random_state=0)\
+            .itertuples():
+        candidates = [w for w in windows.get(t.customer_id, [])
+                      if w[0] <= t.time <= w[1]]
+        expected = max(candidates, key=lambda w: w[0])[2] \
+            if candidates else None
+        assert attributed[t.Index] == expected
+
+
+def test_quantile_sketch_bound():
+    from quantile_sketch import QuantileSketch
+    rng = np.random.default_rng(0)
+    for n in [1, 2, 4, 5, 50, 1000]:
+        values = rng.lognormal(3, 1.5, n)
+        values[:n // 5] = 0
+        sketch = QuantileSketch(0.01)
+        for chunk in np.array_split(values, 3):
+            sketch.merge(QuantileSketch(0.01).add(chunk))
+        for q in [0, 0.1, 0.25, 0.5, 0.75, 1]:
+            expected = pd.Series(values).quantile(q)
+            assert abs(sketch.quantile(q) - expected) <= 0.01 * expected \
+                + 1e-12
+
+
+def test_per_customer_data_parity():
+    from eda import per_customer_data, per_customer_data_fast, \
+        per_customer_data_parallel
+    data = synthetic_data()
+    expected = per_customer_data(data['df'], data['profile'])
+    pd.testing.assert_frame_equal(
+        per_customer_data_fast(data['df'], data['profile']), expected)
+    pd.testing.assert_frame_equal(
+        per_customer_data_parallel(data['df'], data['profile'], 2), expected)
+
+
+def test_per_customer_data_sql_parity():
+    import os
+    from eda import per_customer_data_fast
+    from sql_backend import build_database, per_customer_data_sql
+    data = synthetic_data()
+    db_path = build_database(os.path.join(data['dir'], 'transcript.db'),
+                             data['portfolio'], data['transcript_path'],
+                             chunksize=5000)
+    pd.testing.assert_frame_equal(
+        per_customer_data_sql(db_path, data['profile']),
+        per_customer_data_fast(data['df'], data['profile']),
+        check_exact=False, rtol=1e-9)
+
+
+def test_cache_per_data_dir():
+    import os
+    import shutil
+    from data_cache import load_datasets, data_dir_key
+    data = synthetic_data()
+    cache_dir = tempfile.mkdtemp()
+    dirs = [os.path.join(data['dir'], name) for name in ['a', 'b']]
+    for d in dirs:
+        os.makedirs(d, exist_ok=True)
+        for name in ['portfolio', 'profile', 'transcript']:
+            shutil.copy(os.path.join(data['dir'], name + '.json'), d)
+    built = [load_datasets(d, cache_dir) for d in dirs]
+    # Building the cache of b keeps the one of a, and both are read back
+    for d, datasets in zip(dirs, built):
+        entries = os.listdir(os.path.join(cache_dir, data_dir_key(d)))
+        assert len(entries) == 1 and len(entries[0]) == 64
+        cached = load_datasets(d, cache_dir)
+        pd.testing.assert_frame_equal(cached[-1], datasets[-1])
+
+
+def test_customer_aggregator():
+    from eda import CustomerAggregator, per_customer_data_fast
+    data = synthetic_data()
+    df = data['df']
+    first, second = df[df.time < 300], df[df.time >= 300]
+    init = per_customer_data_fast(first, data['profile'])
+    before = init.copy()
+    aggregator = CustomerAggregator(data['profile'], init)
+    updated = aggregator.update(second[second.time < 500])
+    returned = updated.copy()
+    aggregator.update(second[second.time >= 500])
+    aggregator.verify(df)
+    # Neither the initial frame nor an earlier result change
+    pd.testing.assert_frame_equal(init, before)
+    pd.testing.assert_frame_equal(updated, returned)
+
+
+def test_sorted_quantile():
+    import pytest
+    from recommendations import sorted_quantile
+    values = np.sort(np.random.default_rng(0).lognormal(3, 1.5, 101))
+    for q in [0, 0.1, 0.25, 0.5, 0.7, 0.75, 1]:
+        assert sorted_quantile(values, q) == pd.Series(values).quantile(q)
+    for q in [-0.5, 1.5, np.nan]:
+        with pytest.raises(ValueError):
+            sorted_quantile(values, q)
+        with pytest.raises(ValueError):
+            sorted_quantile([], q)
+
+
+def test_service_validation():
+    import asyncio
+    import json
+    from eda import per_customer_data_fast
+    from recommendation_service import RecommendationService
+    data = synthetic_data()
+    service = RecommendationService(
+        per_customer_data_fast(data['df'], data['profile']))
+
+    async def run():
+        service.queue = asyncio.Queue()
+        batcher = asyncio.create_task(service.batcher())
+        statuses = []
+        for request in [{'q': -0.5}, {'q': 1.5}, {'q': 'x'}, {'n_top': -1},
+                        {'n_top': 0}, {'n_top': 1.5}, {'n_top': True}, [],
+                        {'age': 'x'}, {'age': 40, 'n_top': 3, 'q': 1}]:
+            status, _ = await service.handle('POST', '/recommend',
+                                             json.dumps(request).encode())
+            statuses.append(status)
+        batcher.cancel()
+        return statuses
+
+    assert asyncio.run(run()) == [400] * 9 + [200]
+    metrics = service.metrics()
+    assert metrics['requests'] == 10 and metrics['errors'] == 9
+
+
+def test_load_transcript():
+    import os
+    data = synthetic_data()
+    transcript = pd.read_json(data['transcript_path'], orient='records',
+                              lines=True)
+    expected = prepare_transcript(transcript)
+    # Spaced separators as in the original file, and compact ones as
+    # written by to_json
+    compact_path = os.path.join(data['dir'], 'transcript_compact.json')
+    transcript.to_json(compact_path, orient='records', lines=True)
+    for path in [data['transcript_path'], compact_path]:
+        loaded = load_transcript(path, chunksize=5000)
+        pd.testing.assert_frame_equal(loaded, expected)
+
+
+def test_round_age_income():
+    from eda import round_age, round_income
+
+    # Loops of the original round_age and round_income
+    def loop_age(x):
+        for y in range(15, 106, 10):
+            if x >= y and x < y+10:
+                return y
+        return 0
+
+    def loop_income(x):
+        for y in range(30, 130, 10):
+            if x >= y*1000 and x < (y+10)*1000:
+                return y*1000
+        return 0
+
+    cases = [(round_age, loop_age, [0, 14.9, 15, 15.5, 24.9, 25, 104.9, 105,
+                                    114.9, 115, 118, -1, np.nan]),
+             (round_income, loop_income, [0, 29999, 30000, 30000.5, 39999,
+                                          40000, 119999, 120000, 129999,
+                                          130000, 1e9, np.nan])]
+    for vectorized, loop, values in cases:
+        expected = [loop(v) for v in values]
+        for v, e in zip(values, expected):
+            result = vectorized(v)
+            assert result == e and type(result) is int
+        result = vectorized(np.array(values))
+        assert isinstance(result, np.ndarray) and result.dtype == np.int64
+        assert result.tolist() == expected
+        series = pd.Series(values, index=np.arange(len(values)) * 2 + 1,
+                           name='x')
+        pd.testing.assert_series_equal(vectorized(series),
+                                       series.apply(loop))
+
+
+def test_loaders():
+    import os
+    data = synthetic_data()
+    repo_data = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'data')
+    read = lambda path: pd.read_json(path, orient='records', lines=True)
+    for data_dir in [repo_data, data['dir']]:
+        portfolio = os.path.join(data_dir, 'portfolio.json')
+        profile = os.path.join(data_dir, 'profile.json')
+        pd.testing.assert_frame_equal(load_portfolio(portfolio),
+                                      prepare_portfolio(read(portfolio)))
+        pd.testing.assert_frame_equal(load_profile(profile),
+                                      prepare_profile(read(profile)))
+
+
+def customers_data():
+    """ Aggregated data per customer of the synthetic datasets """
+    if 'customers' not in data:
+        from eda import per_customer_data_fast
+        synthetic_data()
+        data['customers'] = per_customer_data_fast(data['df'],
+                                                   data['profile'])
+    return data['customers']
+
+
+def test_segment_index_parity():
+    from itertools import product
+    from recommendations import OFFERS, build_segment_index, \
+        get_most_popular_offers_filtered, get_most_popular_offers_indexed
+    customers = customers_data()
+    index = build_segment_index(customers)
+    # Null, out of range and edge values, age 118 is the age of the
+    # customers without demographic data
+    incomes = [None, np.nan, 10000, 30000, 64999.5, 119999, 120000, 200000]
+    ages = [None, np.nan, 10, 15, 44, 104, 118, 200]
+    genders = [None, np.nan, 'M', 'F', 'O']
+    queries = product(incomes, ages, genders)
+    for i, (income, age, gender) in enumerate(queries):
+        q = [0.5, 0.9][i % 2]
+        expected = get_most_popular_offers_filtered(customers, len(OFFERS), q,
+                                                    income, age, gender)
+        result = get_most_popular_offers_indexed(index, len(OFFERS), q,
+                                                 income, age, gender)
+        assert result[0] == expected[0]
+        np.testing.assert_array_equal([*result[1].values()],
+                                      [*expected[1].values()])
+
+
+def test_batch_parity():
+    from recommendations import get_most_popular_offers_batch, \
+        get_most_popular_offers_filtered
+    customers = customers_data()
+    profile = data['profile'].sample(300, random_state=0)
+    # Null and out of range values next to the sampled customers
+    extra = pd.DataFrame({'income': [np.nan, 10000, 200000, 120000, 55000],
+                          'age': [118, 10, 200, 104, np.nan],
+                          'gender': [None, 'M', np.nan, 'O', 'F']},
+                         index=['x1', 'x2', 'x3', 'x4', 'x5'])
+    profile = pd.concat([profile[['income', 'age', 'gender']], extra])
+    result = get_most_popular_offers_batch(customers, profile, 3, 0.5)
+    assert list(result.index) == list(profile.index)
+    for row in profile.itertuples():
+        gender = None if pd.isnull(row.gender) else row.gender
+        expected = get_most_popular_offers_filtered(customers, 3, 0.5,
+                                                    row.income, row.age,
+                                                    gender)[0]
+        assert list(result.loc[row.Index]) == expected
+
+
+def test_cohort_cube_parity():
+    from itertools import product
+    from eda import OFFER_IDS, OFFER_TYPES, SEGMENT_LEVELS, COHORT_STATS, \
+        cohort_cube, get_offer_stat_by
+    customers = customers_data()
+    cube = cohort_cube(customers)
+    for offer, stat, by_col, aggr in product(OFFER_TYPES + OFFER_IDS,
+                                             COHORT_STATS, SEGMENT_LEVELS,
+                                             ['sum', 'mean']):
+        expected = get_offer_stat_by(customers, stat, offer, by_col, aggr)
+        result = get_offer_stat_by(customers, stat, offer, by_col, aggr,
+                                   cube=cube)
+        for r, e in zip(result, expected):
+            if e is None:
+                assert r is None
+                continue
+            pd.testing.assert_series_equal(r, e, check_exact=False,
+                                           rtol=1e-9)
+
+
+def test_frame_stats_deep():
+    from instrumentation import frame_stats
+    frame = pd.DataFrame({'customer_id': ['c' * 1000] * 1000})
+    rows, mb = frame_stats(frame)
+    assert rows == 1000 and mb > 1000 * 1000 / 2**20
+    assert frame_stats(frame.customer_id)[1] > 1000 * 1000 / 2**20